@@ -111,6 +111,40 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+# Every worker must see the same catalog version and cart entries, or a
+# price edit only reaches the process that saved it: the default is the
+# Redis already running for channels (main.checks warns about caches
+# local to a process)
+CACHES = {"default": env.cache("CACHE_URL", default="rediscache://127.0.0.1:6379/1")}
+
+# Catalog pages and querysets are cached under a version that is bumped
+# whenever products, tags or images change, so this only bounds memory
+CATALOG_CACHE_TIMEOUT = env.int("CATALOG_CACHE_TIMEOUT", default=60 * 60)
+
+# The cart of a session is cached for a short while (and dropped from the
+# cache whenever it is saved), see main.middlewares
+CART_CACHE_TIMEOUT = env.int("CART_CACHE_TIMEOUT", default=5 * 60)
+
+# Bestseller rankings only move with new orders, a few minutes late is fine
+BESTSELLERS_CACHE_TIMEOUT = env.int("BESTSELLERS_CACHE_TIMEOUT", default=5 * 60)
+
+# "database" creates a Cart row on the first add to cart, "session" keeps
+# the carts of anonymous visitors in their session until they log in or
+# check out (see main.carts)
+CART_STORAGE = env.str("CART_STORAGE", default="database")
+
+# Background jobs (see main.jobs and the run_jobs command)
+JOBS_CONCURRENCY = env.int("JOBS_CONCURRENCY", default=2)
+JOBS_MAX_ATTEMPTS = 5
+# seconds before the first retry, doubled on every further attempt
+JOBS_RETRY_DELAY = 30
+JOBS_POLL_INTERVAL = 2
+# seconds after which a running job is considered abandoned
+JOBS_STALE_AFTER = 10 * 60
+
 # Email Backend
 EMAIL_BACKEND = (
     "django.core.mail.backends.console.EmailBackend"  # used in development mode only
@@ -153,6 +187,18 @@ STATIC_URL = "/static/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 MEDIA_URL = "/media/"
 
+# Widths (in pixels) of the resized copies made for every product image,
+# each one is written as WebP and JPEG
+PRODUCT_IMAGE_WIDTHS = (160, 320, 640, 1024)
+PRODUCT_IMAGE_QUALITY = 80
+# Uploads over this many pixels are refused before being decoded, and no
+# image may need more than this many bytes of pixel data once decoded
+# (JPEGs are decoded at a reduced scale, so most large scans still fit)
+PRODUCT_IMAGE_MAX_PIXELS = env.int("PRODUCT_IMAGE_MAX_PIXELS", default=100_000_000)
+PRODUCT_IMAGE_MEMORY_BUDGET = env.int(
+    "PRODUCT_IMAGE_MEMORY_BUDGET", default=64 * 1024 * 1024
+)
+
 # Logging
 LOGGING = {
     "version": 1,
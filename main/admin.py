@@ -1,20 +1,24 @@
 import logging
-import tempfile
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
 
+import pytz
+
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.utils import flatten_fieldsets
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
-from django.db.models import Count
-from django.db.models.functions import TruncDay
-from django.forms import forms, TypedChoiceField
-from django.http import HttpResponse
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db.models import Sum
+from django.forms import forms, ChoiceField, DateField, TypedChoiceField
+from django.http import FileResponse, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render
-from django.template.loader import render_to_string
 from django.template.response import TemplateResponse
 from django.urls import path
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.utils.html import format_html
-from weasyprint import HTML
 
+from . import analytics, exports, invoices
 from .models import (
     Product,
     ProductImage,
@@ -24,6 +28,8 @@ from .models import (
     Cart,
     OrderLine,
     Order,
+    OrderDailyRollup,
+    ProductDailySales,
     Address,
 )
 
@@ -32,9 +38,9 @@ logger = logging.getLogger(__name__)
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ("name", "slug", "in_stock", "price")
+    list_display = ("name", "slug", "in_stock", "stock", "price")
     list_filter = ("active", "in_stock", "date_updated")
-    list_editable = ("in_stock",)
+    list_editable = ("in_stock", "stock")
     search_fields = ("name",)
     prepopulated_fields = {"slug": ("name",)}
     autocomplete_fields = ("tags",)
@@ -84,8 +90,9 @@ class ProductTagAdmin(admin.ModelAdmin):
 
 @admin.register(ProductImage)
 class ProductImageAdmin(admin.ModelAdmin):
-    list_display = ("thumbnail_tag", "product_name")
-    readonly_fields = ("thumbnail",)
+    list_display = ("thumbnail_tag", "product_name", "status")
+    list_filter = ("status",)
+    readonly_fields = ("thumbnail", "status")
     search_fields = ("product__name",)
 
     # this function returns HTML for the first column defined
@@ -148,12 +155,30 @@ class ProductInCartInline(admin.TabularInline):
 
 @admin.register(Cart)
 class CartAdmin(admin.ModelAdmin):
-    list_display = ("id", "user", "status", "count")
+    list_display = ("id", "user", "status", "item_count", "total")
     list_editable = ("status",)
     list_filter = ("status",)
     inlines = (ProductInCartInline,)
 
 
+def mark_lines_processing(modeladmin, request, queryset):
+    count = OrderLine.objects.filter(order__in=queryset).transition(
+        OrderLine.PROCESSING
+    )
+    modeladmin.message_user(request, "%d lines marked as processing." % count)
+
+
+mark_lines_processing.short_description = "Mark all their lines as processing"
+
+
+def mark_lines_sent(modeladmin, request, queryset):
+    count = OrderLine.objects.filter(order__in=queryset).transition(OrderLine.SENT)
+    modeladmin.message_user(request, "%d lines marked as sent." % count)
+
+
+mark_lines_sent.short_description = "Mark all their lines as sent"
+
+
 class OrderLineInline(admin.TabularInline):
     model = OrderLine
     raw_id_fields = ("product",)
@@ -165,6 +190,7 @@ class OrderAdmin(admin.ModelAdmin):
     list_editable = ("status",)
     list_filter = ("status", "shipping_country", "date_created")
     inlines = (OrderLineInline,)
+    actions = (mark_lines_processing, mark_lines_sent)
     fieldsets = (
         (None, {"fields": ("user", "status")}),
         (
@@ -210,6 +236,7 @@ class CentralOfficeOrderAdmin(admin.ModelAdmin):
     readonly_fields = ("user",)
     list_filter = ("status", "shipping_country", "date_created")
     inlines = (CentralOfficeOrderLineInline,)
+    actions = (mark_lines_processing, mark_lines_sent)
     fieldsets = (
         (None, {"fields": ("user", "status")}),
         (
@@ -251,6 +278,7 @@ class DispatchersOrderAdmin(admin.ModelAdmin):
     )
     list_filter = ("status", "shipping_country", "date_created")
     inlines = (CentralOfficeOrderLineInline,)
+    actions = (mark_lines_processing, mark_lines_sent)
     fieldsets = (
         (
             "Shipping info",
@@ -285,6 +313,8 @@ class ColoredAdminSite(admin.sites.AdminSite):
 
 
 class ReportingColoredAdminSite(ColoredAdminSite):
+    top_products = 20
+
     def get_urls(self):
         urls = super(ReportingColoredAdminSite, self).get_urls()
         my_urls = [
@@ -298,16 +328,33 @@ class ReportingColoredAdminSite(ColoredAdminSite):
                 self.admin_view(self.most_bought_products),
                 name="most-bought-products",
             ),
+            path(
+                "sales_analytics/",
+                self.admin_view(self.sales_analytics),
+                name="sales-analytics",
+            ),
+            path(
+                "customer_cohorts/",
+                self.admin_view(self.customer_cohorts),
+                name="customer-cohorts",
+            ),
         ]
         return my_urls + urls
 
+    # Reads the daily rollup (a few rows per day), optionally narrowed
+    # with ?status=<status>&country=<shipping country>
     def orders_per_day(self, request):
-        starting_day = datetime.now() - timedelta(days=180)
+        starting_day = timezone.localdate() - timedelta(days=180)
+        rollups = OrderDailyRollup.objects.filter(day__gt=starting_day)
+        if request.GET.get("status", "").isdigit():
+            rollups = rollups.filter(status=request.GET["status"])
+        if request.GET.get("country"):
+            rollups = rollups.filter(shipping_country=request.GET["country"])
         order_data = (
-            Order.objects.filter(date_created__gt=starting_day)
-            .annotate(day=TruncDay("date_created"))
-            .values("day")
-            .annotate(c=Count("id"))
+            rollups.values("day")
+            .annotate(c=Sum("count"))
+            .filter(c__gt=0)
+            .order_by("day")
         )
         labels = [x["day"].strftime("%Y-%m-%d") for x in order_data]
         values = [x["c"] for x in order_data]
@@ -322,23 +369,23 @@ class ReportingColoredAdminSite(ColoredAdminSite):
         return TemplateResponse(request, "orders_per_day.html", context)
 
     def most_bought_products(self, request):
+        labels = values = None
         if request.method == "POST":
             form = PeriodSelectForm(request.POST)
             if form.is_valid():
-                days = form.cleaned_data["period"]
-                starting_day = datetime.now() - timedelta(days=days)
-                data = (
-                    OrderLine.objects.filter(order__date_created__gt=starting_day)
-                    .values("product__name")
-                    .annotate(c=Count("id"))
+                ranking = ProductDailySales.objects.top(
+                    form.cleaned_data["period"], limit=self.top_products
+                )
+                names = dict(
+                    Product.objects.filter(
+                        pk__in=[product_id for product_id, _ in ranking]
+                    ).values_list("id", "name")
                 )
-                logger.info("most_bought_products query: %s", data.query)
-                labels = [x["product__name"] for x in data]
-                values = [x["c"] for x in data]
+                ranking = [row for row in ranking if row[0] in names]
+                labels = [names[product_id] for product_id, _ in ranking]
+                values = [units for _, units in ranking]
         else:
             form = PeriodSelectForm()
-            labels = None
-            values = None
         context = dict(
             self.each_context(request),
             title="Most bought products",
@@ -349,10 +396,47 @@ class ReportingColoredAdminSite(ColoredAdminSite):
 
         return TemplateResponse(request, "most_bought_products.html", context)
 
+    def analytics_form(self, request, granularity):
+        data = request.GET or {
+            "granularity": granularity,
+            "timezone": settings.TIME_ZONE,
+        }
+        return AnalyticsForm(data)
+
+    def sales_analytics(self, request):
+        form = self.analytics_form(request, "day")
+        report = None
+        if form.is_valid():
+            report = analytics.sales(*form.get_range())
+        context = dict(
+            self.each_context(request),
+            title="Sales analytics",
+            form=form,
+            report=report,
+            labels=[row["period"] for row in report["periods"]] if report else None,
+            values=[row["revenue"] for row in report["periods"]] if report else None,
+        )
+        return TemplateResponse(request, "sales_analytics.html", context)
+
+    def customer_cohorts(self, request):
+        form = self.analytics_form(request, "month")
+        report = None
+        if form.is_valid():
+            report = analytics.cohorts(*form.get_range())
+        context = dict(
+            self.each_context(request),
+            title="Customer cohorts",
+            form=form,
+            report=report,
+        )
+        return TemplateResponse(request, "customer_cohorts.html", context)
+
     def index(self, request, extra_context=None):
         reporting_pages = [
             {"name": "Orders Per Day", "link": "orders_per_day/"},
             {"name": "Most bought products", "link": "most_bought_products/"},
+            {"name": "Sales analytics", "link": "sales_analytics/"},
+            {"name": "Customer cohorts", "link": "customer_cohorts/"},
         ]
         if not extra_context:
             extra_context = {}
@@ -379,29 +463,97 @@ class InvoiceMixin:
         order = get_object_or_404(Order, pk=order_id)
 
         if request.GET.get("format") == "pdf":
-            html_string = render_to_string("invoice.html", {"order": order})
-            html = HTML(string=html_string, base_url=request.build_absolute_uri())
-
-            result = html.write_pdf()
-
-            response = HttpResponse(content_type="application/pdf")
+            response = FileResponse(
+                invoices.open_invoice(order), content_type="application/pdf"
+            )
             response["Content-Disposition"] = "inline; filename=invoice.pdf"
             response["Content-Transfer-Encoding"] = "binary"
-
-            with tempfile.NamedTemporaryFile(delete=True) as output:
-                output.write(result)
-                output.flush()
-                output = open(output.name, "rb")
-                binary_pdf = output.read()
-                response.write(binary_pdf)
             return response
 
         return render(request, "invoice.html", {"order": order})
 
 
+# Orders and their lines can be exported by every site, with the fields
+# and orders its Order admin shows (so dispatchers get no billing data)
+class ExportMixin:
+    ORDER_EXPORT_FIELDS = ("id", "date_created", "date_updated")
+    LINE_EXPORT_FIELDS = (
+        "id",
+        "order",
+        "product",
+        "product__name",
+        "status",
+        "quantity",
+        "quantity_sent",
+        "price",
+    )
+
+    def get_urls(self):
+        urls = super(ExportMixin, self).get_urls()
+        my_urls = [
+            path(
+                "export/orders/",
+                self.admin_view(self.export_orders),
+                name="export-orders",
+            ),
+            path(
+                "export/orderlines/",
+                self.admin_view(self.export_orderlines),
+                name="export-orderlines",
+            ),
+        ]
+        return my_urls + urls
+
+    def exported_orders(self, request):
+        """The Order admin of this site and the orders it lets the user see.
+
+        Narrowed with ``?since=`` and ``?until=`` (inclusive dates).
+        """
+        order_admin = self._registry[Order]
+        if not order_admin.has_view_or_change_permission(request):
+            raise PermissionDenied
+        orders = order_admin.get_queryset(request).order_by("id")
+        for param, lookup in (("since", "gte"), ("until", "lte")):
+            if request.GET.get(param):
+                day = parse_date(request.GET[param])
+                if day is None:
+                    raise ValidationError("%s must be a YYYY-MM-DD date" % param)
+                orders = orders.filter(**{"date_created__date__" + lookup: day})
+        return order_admin, orders
+
+    def export_format(self, request):
+        fmt = request.GET.get("format", "csv")
+        if fmt not in exports.FORMATS:
+            raise ValidationError(
+                "format must be one of %s" % ", ".join(exports.FORMATS)
+            )
+        return fmt
+
+    def export_orders(self, request):
+        try:
+            order_admin, orders = self.exported_orders(request)
+            fmt = self.export_format(request)
+        except ValidationError as e:
+            return HttpResponseBadRequest("; ".join(e.messages))
+        fields = list(self.ORDER_EXPORT_FIELDS)
+        for field in flatten_fieldsets(order_admin.get_fieldsets(request)):
+            if field not in fields:
+                fields.append(field)
+        return exports.export(orders, fields, fmt, "orders")
+
+    def export_orderlines(self, request):
+        try:
+            _, orders = self.exported_orders(request)
+            fmt = self.export_format(request)
+        except ValidationError as e:
+            return HttpResponseBadRequest("; ".join(e.messages))
+        lines = OrderLine.objects.filter(order__in=orders.values("id")).order_by("id")
+        return exports.export(lines, self.LINE_EXPORT_FIELDS, fmt, "orderlines")
+
+
 # Finally we define 3 instances of AdminSite, each with their own
 # set of required permissions and colors
-class OwnersAdminSite(InvoiceMixin, ReportingColoredAdminSite):
+class OwnersAdminSite(ExportMixin, InvoiceMixin, ReportingColoredAdminSite):
     site_header = "Intensive Galaxy Owners Administration"
     site_header_color = "black"
     module_caption_color = "grey"
@@ -410,7 +562,7 @@ class OwnersAdminSite(InvoiceMixin, ReportingColoredAdminSite):
         return request.user.is_active and request.user.is_superuser
 
 
-class CentralOfficeAdminSite(InvoiceMixin, ReportingColoredAdminSite):
+class CentralOfficeAdminSite(ExportMixin, InvoiceMixin, ReportingColoredAdminSite):
     site_header = "Intensive Galaxy Central Office Administration"
     site_header_color = "purple"
     module_caption_color = "pink"
@@ -419,7 +571,7 @@ class CentralOfficeAdminSite(InvoiceMixin, ReportingColoredAdminSite):
         return request.user.is_active and request.user.is_employee
 
 
-class DispatchersAdminSite(ColoredAdminSite):
+class DispatchersAdminSite(ExportMixin, ColoredAdminSite):
     site_header = "Intensive Galaxy Dispatch Administration"
     site_header_color = "green"
     module_caption_color = "lightgreen"
@@ -433,6 +585,35 @@ class PeriodSelectForm(forms.Form):
     period = TypedChoiceField(choices=PERIODS, coerce=int, required=True)
 
 
+class AnalyticsForm(forms.Form):
+    DEFAULT_DAYS = 90
+
+    granularity = ChoiceField(
+        choices=[(key, key.capitalize()) for key in analytics.GRANULARITIES]
+    )
+    timezone = ChoiceField(choices=[(name, name) for name in pytz.common_timezones])
+    start = DateField(required=False)
+    end = DateField(required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        end = cleaned_data.get("end") or timezone.localdate()
+        start = cleaned_data.get("start") or end - timedelta(days=self.DEFAULT_DAYS)
+        if start > end:
+            raise ValidationError("The start must not be after the end.")
+        cleaned_data.update(start=start, end=end)
+        return cleaned_data
+
+    def get_range(self):
+        """``(start, end, granularity, tz)`` for ``main.analytics``"""
+        tz = pytz.timezone(self.cleaned_data["timezone"])
+        start = tz.localize(datetime.combine(self.cleaned_data["start"], time.min))
+        end = tz.localize(
+            datetime.combine(self.cleaned_data["end"] + timedelta(days=1), time.min)
+        )
+        return start, end, self.cleaned_data["granularity"], tz
+
+
 main_admin = OwnersAdminSite()
 main_admin.register(Product, ProductAdmin)
 main_admin.register(ProductTag, ProductTagAdmin)
@@ -0,0 +1,243 @@
+"""
+Revenue and sales analytics.
+
+Orders and their lines are streamed from the database in chunks of
+plain tuples into NumPy columns, one array per field. The database only
+filters and truncates timestamps to the requested granularity (in the
+requested timezone); every figure is then a few vectorized passes over
+the columns: ``np.unique`` turns periods into small integer codes and
+``np.bincount`` sums anything per period.
+
+Only paid orders count (``PAID`` and ``DONE``). Revenue is what was
+ordered, at the unit prices stored on the lines when the order was
+placed, less the cancelled lines.
+"""
+import logging
+from datetime import timedelta
+from itertools import islice
+
+import numpy as np
+from django.db.models import (
+    Case,
+    DateTimeField,
+    F,
+    IntegerField,
+    OuterRef,
+    Subquery,
+    Value,
+    When,
+)
+from django.db.models.functions import TruncDay, TruncHour, TruncMonth, TruncWeek
+from django.utils import timezone
+
+from .models import Order, OrderLine
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 5000
+PAID_STATUSES = (Order.PAID, Order.DONE)
+
+GRANULARITIES = {
+    "hour": (TruncHour, "%Y-%m-%d %H:00"),
+    "day": (TruncDay, "%Y-%m-%d"),
+    "week": (TruncWeek, "%Y-%m-%d"),
+    "month": (TruncMonth, "%Y-%m"),
+}
+
+
+def columns(rows, dtypes, chunk_size=CHUNK_SIZE):
+    """Load an iterable of tuples into one array per field, a chunk at a time"""
+    parts = [[] for _ in dtypes]
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        for part, values, dtype in zip(parts, zip(*chunk), dtypes):
+            part.append(np.array(values, dtype=dtype))
+    return [
+        np.concatenate(part) if part else np.empty(0, dtype=dtype)
+        for part, dtype in zip(parts, dtypes)
+    ]
+
+
+def paid_orders(start, end, statuses=PAID_STATUSES):
+    return Order.objects.filter(
+        status__in=statuses, date_created__gte=start, date_created__lt=end
+    )
+
+
+def load_orders(start, end, granularity, tz, statuses=PAID_STATUSES):
+    """Order ids, customer ids, periods, cohort periods and repeat flags.
+
+    The cohort of an order is the period of its customer's first paid
+    order ever, a repeat order is any order after that first one.
+    """
+    trunc, _ = GRANULARITIES[granularity]
+    first_order = (
+        Order.objects.filter(user=OuterRef("user"), status__in=statuses)
+        .order_by("date_created")
+        .values("date_created")[:1]
+    )
+    orders = (
+        paid_orders(start, end, statuses)
+        .annotate(first_order=Subquery(first_order, output_field=DateTimeField()))
+        .annotate(
+            period=trunc("date_created", tzinfo=tz),
+            cohort=trunc("first_order", tzinfo=tz, output_field=DateTimeField()),
+            repeat=Case(
+                When(date_created__gt=F("first_order"), then=Value(1)),
+                default=Value(0),
+                output_field=IntegerField(),
+            ),
+        )
+        .order_by()
+        .values_list("id", "user_id", "period", "cohort", "repeat")
+    )
+    return columns(
+        orders.iterator(chunk_size=CHUNK_SIZE),
+        (np.int64, np.int64, object, object, np.int8),
+    )
+
+
+def load_lines(start, end, statuses=PAID_STATUSES):
+    """Order ids, quantities and unit prices of the lines of paid orders"""
+    lines = (
+        OrderLine.objects.filter(
+            order__status__in=statuses,
+            order__date_created__gte=start,
+            order__date_created__lt=end,
+        )
+        .exclude(status=OrderLine.CANCELLED)
+        .order_by()
+        .values_list("order_id", "quantity", "price")
+    )
+    return columns(
+        lines.iterator(chunk_size=CHUNK_SIZE), (np.int64, np.int64, np.float64)
+    )
+
+
+def order_positions(order_ids, line_order_ids):
+    """Index into ``order_ids`` of the order of each line, -1 when missing"""
+    by_id = np.argsort(order_ids)
+    sorted_ids = order_ids[by_id]
+    found = np.searchsorted(sorted_ids, line_order_ids)
+    found = np.minimum(found, max(len(sorted_ids) - 1, 0))
+    positions = np.full(len(line_order_ids), -1, dtype=np.int64)
+    if len(sorted_ids):
+        matches = sorted_ids[found] == line_order_ids
+        positions[matches] = by_id[found[matches]]
+    return positions
+
+
+def period_start(moment, granularity, tz=None):
+    """Start of the period ``moment`` falls in, in ``tz``"""
+    tz = tz or timezone.get_current_timezone()
+    local = timezone.localtime(moment, tz).replace(
+        minute=0, second=0, microsecond=0, tzinfo=None
+    )
+    if granularity != "hour":
+        local = local.replace(hour=0)
+    if granularity == "week":
+        local -= timedelta(days=local.weekday())
+    elif granularity == "month":
+        local = local.replace(day=1)
+    return timezone.make_aware(local, tz)
+
+
+def label(period, granularity):
+    return period.strftime(GRANULARITIES[granularity][1])
+
+
+def sales(start, end, granularity="day", tz=None):
+    """Revenue, orders, AOV, units and repeat rate per period.
+
+    Returns ``{"periods": [...], "totals": {...}}``, a dict per period
+    that had paid orders, oldest first.
+    """
+    order_ids, customers, periods, _, repeats = load_orders(start, end, granularity, tz)
+    line_orders, quantities, prices = load_lines(start, end)
+
+    labels, codes = np.unique(periods, return_inverse=True)
+    size = len(labels)
+    positions = order_positions(order_ids, line_orders)
+    # lines of orders created after the orders were read are left out
+    known = positions >= 0
+    line_codes = codes[positions[known]]
+
+    orders = np.bincount(codes, minlength=size)
+    revenue = np.bincount(
+        line_codes, weights=(quantities * prices)[known], minlength=size
+    )
+    units = np.bincount(line_codes, weights=quantities[known], minlength=size)
+    repeat_orders = np.bincount(codes, weights=repeats, minlength=size)
+    rows = [
+        {
+            "period": label(labels[i], granularity),
+            "orders": int(orders[i]),
+            "revenue": round(float(revenue[i]), 2),
+            "aov": round(float(revenue[i] / orders[i]), 2),
+            "units": int(units[i]),
+            "repeat_rate": float(repeat_orders[i] / orders[i]),
+        }
+        for i in range(size)
+    ]
+
+    count = int(orders.sum())
+    totals = {
+        "orders": count,
+        "customers": len(np.unique(customers)),
+        "revenue": round(float(revenue.sum()), 2),
+        "aov": round(float(revenue.sum() / count), 2) if count else 0,
+        "units": int(units.sum()),
+        "repeat_rate": float(repeats.sum() / count) if count else 0,
+    }
+    return {"periods": rows, "totals": totals}
+
+
+def cohorts(start, end, granularity="month", tz=None):
+    """Customer retention by cohort (the period of their first order).
+
+    Returns ``{"periods": [labels], "cohorts": [...]}`` with, for every
+    cohort that started within the range, its size and the share of its
+    customers who ordered in each later period. The range starts at the
+    beginning of the period of ``start``, so that the first cohort is
+    whole.
+    """
+    start = period_start(start, granularity, tz)
+    _, customers, periods, cohort_periods, _ = load_orders(start, end, granularity, tz)
+    # periods and cohorts share one axis, cohorts may predate the range
+    labels, codes = np.unique(
+        np.concatenate([periods, cohort_periods]), return_inverse=True
+    )
+    size = len(labels)
+    period_codes, cohort_codes = codes[: len(periods)], codes[len(periods) :]
+
+    # one entry per customer and period they ordered in
+    active = np.unique(customers * size + period_codes)
+    active_customers, active_periods = np.divmod(active, size)
+    customer_ids, first = np.unique(customers, return_index=True)
+    customer_cohorts = cohort_codes[first][
+        np.searchsorted(customer_ids, active_customers)
+    ]
+    matrix = np.zeros((size, size), dtype=np.int64)
+    np.add.at(matrix, (customer_cohorts, active_periods), 1)
+
+    # every customer of a cohort within the range ordered in its period
+    new_customers = matrix.diagonal()
+    rows = []
+    for i in np.flatnonzero(new_customers):
+        rows.append(
+            {
+                "cohort": label(labels[i], granularity),
+                "customers": int(new_customers[i]),
+                "retention": [
+                    float(share) for share in matrix[i, i:] / new_customers[i]
+                ],
+            }
+        )
+    logger.info("Computed %d cohorts over %d periods", len(rows), size)
+    return {
+        "periods": [label(period, granularity) for period in labels],
+        "cohorts": rows,
+    }
@@ -1,17 +1,114 @@
-from rest_framework import viewsets
+import hashlib
 
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import permissions, viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from main import search
 from main.models import OrderLine, Order
-from main.serializers import OrderLineSerializer, OrderSerializer
+from main.serializers import (
+    OrderLineSerializer,
+    OrderLineTransitionSerializer,
+    OrderSerializer,
+    ProductSerializer,
+)
+
+
+class ConditionalGetMixin:
+    """Conditional GET Mixin
+
+    Notes
+    -----
+    Adds ETag and Last-Modified to list and detail responses and answers
+    matching If-None-Match / If-Modified-Since requests with a 304
+    before anything is serialized. Validators come from the
+    ``conditional_fields`` timestamps of the (filtered) queryset.
+    """
+
+    conditional_fields = ("date_updated",)
+
+    def get_list_validators(self, queryset):
+        aggregates = {
+            "modified_%d" % i: Max(field)
+            for i, field in enumerate(self.conditional_fields)
+        }
+        data = queryset.order_by().aggregate(count=Count("pk"), **aggregates)
+        stamps = [data["modified_%d" % i] for i in range(len(aggregates))]
+        return [data["count"]] + stamps, max(filter(None, stamps), default=None)
+
+    def get_object_validators(self, obj):
+        return [obj.pk, obj.date_updated], obj.date_updated
 
+    def conditional_response(self, request, validators, response_func):
+        values, last_modified = validators
+        key = repr((values, request.get_full_path(), request.META.get("HTTP_ACCEPT")))
+        etag = quote_etag(hashlib.md5(key.encode()).hexdigest())
+        last_modified = last_modified and int(last_modified.timestamp())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = response_func()
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified)
+        return response
 
-class PaidOrderLineViewSet(viewsets.ModelViewSet):
+    def list(self, request, *args, **kwargs):
+        validators = self.get_list_validators(self.filter_queryset(self.get_queryset()))
+        return self.conditional_response(
+            request,
+            validators,
+            lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs),
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        validators = self.get_object_validators(self.get_object())
+        return self.conditional_response(
+            request,
+            validators,
+            lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs),
+        )
+
+
+class PaidOrderLineViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = OrderLine.objects.filter(order__status=Order.PAID).order_by(
         "-order__date_created"
     )
     serializer_class = OrderLineSerializer
     filter_fields = ("order", "status")
+    conditional_fields = ("date_updated", "order__date_updated")
+
+    @action(detail=False, methods=["post"])
+    def transition(self, request):
+        """Move many lines to one status: ``{"ids": [...], "status": 30}``"""
+        serializer = OrderLineTransitionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        lines = self.get_queryset().filter(id__in=serializer.validated_data["ids"])
+        count = lines.transition(serializer.validated_data["status"])
+        return Response({"updated": count})
 
 
-class PaidOrderViewSet(viewsets.ModelViewSet):
-    queryset = Order.objects.filter(status=Order.PAID).order_by("-date_added")
+class PaidOrderViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
+    queryset = Order.objects.filter(status=Order.PAID).order_by("-date_created")
     serializer_class = OrderSerializer
+
+
+class ProductSearchView(APIView):
+    permission_classes = (permissions.AllowAny,)
+    limit = 20
+
+    def get(self, request):
+        query = request.query_params.get("q", "").strip()
+        try:
+            limit = max(1, min(int(request.query_params.get("limit", self.limit)), 100))
+        except ValueError:
+            limit = self.limit
+        results = search.search(query, limit=limit)
+        return Response(
+            {"query": query, "results": ProductSerializer(results, many=True).data}
+        )
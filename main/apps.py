@@ -5,4 +5,7 @@ class MainConfig(AppConfig):
     name = "main"
 
     def ready(self):
-        from . import signals
+        from . import checks, signals
+
+        # background job handlers register themselves on import
+        from . import imaging, invoices
@@ -0,0 +1,62 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+CATALOG_VERSION_KEY = "catalog:version"
+
+
+def _fresh_version():
+    # never restart from a small number after an eviction, old keys
+    # could still be around for it
+    return int(time.time() * 1000)
+
+
+def catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, _fresh_version(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def _bump():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, _fresh_version(), timeout=None)
+
+
+def bump_catalog_version():
+    """Invalidate every catalog cache entry.
+
+    The version is bumped right away and once more when the current
+    transaction commits, so a page rendered from uncommitted data in
+    between can never stay in the cache.
+    """
+    _bump()
+    transaction.on_commit(_bump)
+
+
+def catalog_key(*parts):
+    digest = hashlib.md5(repr(parts).encode()).hexdigest()
+    return "catalog:%s:%s" % (catalog_version(), digest)
+
+
+def get_or_set(key, default, timeout=None):
+    if timeout is None:
+        timeout = settings.CATALOG_CACHE_TIMEOUT
+    return cache.get_or_set(key, default, timeout)
+
+
+def cart_key(cart_id):
+    return "cart:%s" % cart_id
+
+
+def invalidate_cart(cart_id):
+    """Forget a cached cart, now and when the transaction commits"""
+    key = cart_key(cart_id)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
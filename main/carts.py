@@ -0,0 +1,129 @@
+"""
+Anonymous carts kept in the session.
+
+With ``CART_STORAGE = "session"`` a visitor who is not logged in gets a
+``SessionCart`` instead of a ``Cart`` row: browsing and adding to the
+cart write nothing to the carts tables. The session cart is turned into
+a ``Cart`` with its ``ProductInCart`` lines (``materialize``) when the
+visitor logs in or starts checking out.
+"""
+import logging
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Cart, Product, ProductInCart
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = "cart"
+DATABASE = "database"
+SESSION = "session"
+
+
+def uses_session(user):
+    return settings.CART_STORAGE == SESSION and not user.is_authenticated
+
+
+class SessionCart:
+    """A cart stored in the session, with the interface views use of Cart
+
+    Notes
+    -----
+    The session holds ``{product id: quantity}`` and a summary priced
+    when products are added; the summary is repriced whenever the lines
+    are loaded with their products.
+    """
+
+    id = None
+
+    def __init__(self, session):
+        self.session = session
+        self.data = session.get(SESSION_KEY) or {
+            "lines": {},
+            "item_count": 0,
+            "total": "0",
+        }
+
+    @property
+    def item_count(self):
+        return self.data["item_count"]
+
+    @property
+    def total(self):
+        return Decimal(self.data["total"])
+
+    def count(self):
+        return self.item_count
+
+    def is_empty(self):
+        return self.item_count == 0
+
+    def _save(self):
+        self.session[SESSION_KEY] = self.data
+        self.session.modified = True
+
+    def add_product(self, product, quantity=1):
+        key = str(product.id)
+        self.data["lines"][key] = self.data["lines"].get(key, 0) + quantity
+        self.data["item_count"] += quantity
+        self.data["total"] = str(self.total + quantity * product.price)
+        self._save()
+
+    def lines(self):
+        """``(product, quantity)`` pairs, dropping products that are gone"""
+        quantities = {int(key): value for key, value in self.data["lines"].items()}
+        products = Product.objects.in_bulk(list(quantities))
+        lines = [
+            (products[product_id], quantity)
+            for product_id, quantity in sorted(quantities.items())
+            if product_id in products
+        ]
+        self._set_lines(lines)
+        return lines
+
+    def update_quantities(self, quantities):
+        """Apply ``{product id: quantity}``, a quantity of 0 removes the line"""
+        lines = []
+        for product, quantity in self.lines():
+            quantity = quantities.get(product.id, quantity)
+            if quantity > 0:
+                lines.append((product, quantity))
+        self._set_lines(lines)
+
+    def _set_lines(self, lines):
+        self.data = {
+            "lines": {str(product.id): quantity for product, quantity in lines},
+            "item_count": sum(quantity for _, quantity in lines),
+            "total": str(
+                sum((quantity * product.price for product, quantity in lines), 0)
+            ),
+        }
+        self._save()
+
+    def clear(self):
+        self.session.pop(SESSION_KEY, None)
+
+    def materialize(self, user, cart=None):
+        """Write the lines to a new cart of ``user``, or merge them into ``cart``.
+
+        The session then refers to that cart instead, which is returned.
+        """
+        lines = self.lines()
+        with transaction.atomic():
+            new_cart = Cart.objects.create(user=user)
+            ProductInCart.objects.bulk_create(
+                ProductInCart(cart=new_cart, product=product, quantity=quantity)
+                for product, quantity in lines
+            )
+            if cart is None:
+                Cart.objects.recompute_summary(Cart.objects.filter(pk=new_cart.pk))
+                cart = new_cart
+            else:
+                cart.merge(new_cart)
+        cart.refresh_summary()
+        self.clear()
+        self.session["cart_id"] = cart.id
+        logger.info("Saved session cart as cart id %d", cart.id)
+        return cart
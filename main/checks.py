@@ -0,0 +1,31 @@
+"""
+System checks of the deployment settings this app relies on.
+"""
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+PROCESS_LOCAL_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """The catalog version and the cached carts must be shared by workers"""
+    backend = settings.CACHES["default"]["BACKEND"]
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [
+        Warning(
+            "The default cache is local to each process.",
+            hint=(
+                "Catalog pages and carts are invalidated in the cache of the "
+                "process that changed them only, other workers serve stale "
+                "copies until they expire. Set CACHE_URL to a shared cache "
+                "(rediscache://...) when running several workers."
+            ),
+            obj=backend,
+            id="main.W001",
+        )
+    ]
@@ -0,0 +1,242 @@
+"""
+Catalog facets backed by precomputed bitmaps.
+
+Each facet value (a tag, a price bucket, being in stock, being active)
+owns a ``FacetBitmap`` holding one bit per product id. The bitmaps are
+kept up to date from product signals, so the counts next to every
+filter option are bit intersections instead of GROUP BY queries.
+"""
+import logging
+from decimal import Decimal
+
+from django.db import transaction
+
+from .models import FacetBitmap, Product, ProductTag
+
+logger = logging.getLogger(__name__)
+
+PRICE_BUCKETS = (
+    ("0-10", "Under 10", Decimal("0"), Decimal("10")),
+    ("10-25", "10 to 25", Decimal("10"), Decimal("25")),
+    ("25-50", "25 to 50", Decimal("25"), Decimal("50")),
+    ("50-100", "50 to 100", Decimal("50"), Decimal("100")),
+    ("100+", "100 and over", Decimal("100"), None),
+)
+PRICE_BUCKET_KEYS = [bucket[0] for bucket in PRICE_BUCKETS]
+
+ACTIVE_VALUE = "1"
+STOCK_VALUE = "1"
+
+
+def to_int(bits):
+    return int.from_bytes(bytes(bits or b""), "little")
+
+
+def to_bytes(number):
+    return number.to_bytes((number.bit_length() + 7) // 8, "little")
+
+
+def popcount(number):
+    return bin(number).count("1")
+
+
+def price_bucket(price):
+    """Key of the bucket of a price, prices below 0 go to the first one"""
+    price = Decimal(str(price))
+    for key, _, low, high in PRICE_BUCKETS:
+        if price >= low and (high is None or price < high):
+            return key
+    return PRICE_BUCKETS[0][0]
+
+
+def price_range(key):
+    for bucket_key, _, low, high in PRICE_BUCKETS:
+        if bucket_key == key:
+            return low, high
+    return None
+
+
+def load(facet, values=None):
+    """Return ``{value: int bitmap}`` for a facet, optionally restricted."""
+    bitmaps = FacetBitmap.objects.filter(facet=facet)
+    if values is not None:
+        bitmaps = bitmaps.filter(value__in=[str(v) for v in values])
+    return {value: to_int(bits) for value, bits in bitmaps.values_list("value", "bits")}
+
+
+def _update_bits(facet, value, add=(), remove=()):
+    mask_add = 0
+    for product_id in add:
+        mask_add |= 1 << product_id
+    mask_remove = 0
+    for product_id in remove:
+        mask_remove |= 1 << product_id
+    with transaction.atomic():
+        bitmap, _ = FacetBitmap.objects.select_for_update().get_or_create(
+            facet=facet, value=str(value)
+        )
+        old = to_int(bitmap.bits)
+        new = (old | mask_add) & ~mask_remove
+        if new != old:
+            bitmap.bits = to_bytes(new)
+            bitmap.save(update_fields=["bits"])
+
+
+def _apply(changes):
+    """Apply ``(facet, value, add, remove)`` changes in one transaction.
+
+    Bitmap rows are locked in (facet, value) order, so concurrent
+    writers touching several of the shared rows cannot deadlock. Every
+    write goes through here, so that order is the same everywhere.
+    """
+    with transaction.atomic():
+        for facet, value, add, remove in sorted(
+            changes, key=lambda change: (change[0], str(change[1]))
+        ):
+            _update_bits(facet, value, add=add, remove=remove)
+
+
+def _membership(facet, value, product_id, member):
+    present = [product_id]
+    return (facet, value, present if member else (), () if member else present)
+
+
+def update_product(product):
+    """Sync the active, stock and price bitmaps with a saved product.
+
+    Only the bitmaps of values the save changed are written: most saves
+    (a description, a name) lock none of the shared rows.
+    """
+    changes = []
+    if product.has_changed("active"):
+        changes.append(
+            _membership(FacetBitmap.ACTIVE, ACTIVE_VALUE, product.id, product.active)
+        )
+    if product.has_changed("in_stock"):
+        changes.append(
+            _membership(FacetBitmap.STOCK, STOCK_VALUE, product.id, product.in_stock)
+        )
+    if product.has_changed("price"):
+        current = price_bucket(product.price)
+        previous = product.loaded_value("price")
+        if previous is None:
+            # not loaded from the database, nothing to diff against
+            for key in PRICE_BUCKET_KEYS:
+                changes.append(
+                    _membership(FacetBitmap.PRICE, key, product.id, key == current)
+                )
+        elif price_bucket(previous) != current:
+            changes.append(
+                _membership(
+                    FacetBitmap.PRICE, price_bucket(previous), product.id, False
+                )
+            )
+            changes.append(_membership(FacetBitmap.PRICE, current, product.id, True))
+    _apply(changes)
+
+
+def update_tag(tag_id, add=(), remove=()):
+    _apply([(FacetBitmap.TAG, tag_id, add, remove)])
+
+
+def update_product_tags(product_id, tag_ids, member):
+    """Add a product to, or remove it from, the bitmaps of ``tag_ids``"""
+    _apply(
+        _membership(FacetBitmap.TAG, tag_id, product_id, member) for tag_id in tag_ids
+    )
+
+
+def update_stock(add=(), remove=()):
+    _apply([(FacetBitmap.STOCK, STOCK_VALUE, add, remove)])
+
+
+def remove_product(product_id, tag_ids=()):
+    present = [product_id]
+    changes = [
+        (FacetBitmap.ACTIVE, ACTIVE_VALUE, (), present),
+        (FacetBitmap.STOCK, STOCK_VALUE, (), present),
+    ]
+    changes += [(FacetBitmap.PRICE, key, (), present) for key in PRICE_BUCKET_KEYS]
+    changes += [(FacetBitmap.TAG, tag_id, (), present) for tag_id in tag_ids]
+    _apply(changes)
+
+
+def rebuild():
+    """Recompute every bitmap from the product tables."""
+    bitmaps = {}
+
+    def add(facet, value, product_id):
+        key = (facet, str(value))
+        bitmaps[key] = bitmaps.get(key, 0) | (1 << product_id)
+
+    products = Product.objects.values_list("id", "active", "in_stock", "price")
+    for product_id, active, in_stock, price in products.iterator():
+        if active:
+            add(FacetBitmap.ACTIVE, ACTIVE_VALUE, product_id)
+        if in_stock:
+            add(FacetBitmap.STOCK, STOCK_VALUE, product_id)
+        add(FacetBitmap.PRICE, price_bucket(price), product_id)
+    tagged = Product.tags.through.objects.values_list("producttag_id", "product_id")
+    for tag_id, product_id in tagged.iterator():
+        add(FacetBitmap.TAG, tag_id, product_id)
+
+    with transaction.atomic():
+        FacetBitmap.objects.all().delete()
+        FacetBitmap.objects.bulk_create(
+            FacetBitmap(facet=facet, value=value, bits=to_bytes(number))
+            for (facet, value), number in bitmaps.items()
+        )
+    logger.info("Rebuilt %d facet bitmaps", len(bitmaps))
+    return len(bitmaps)
+
+
+def facet_counts(tag_ids=(), price=None, in_stock=False):
+    """Return the filter options of the catalog with their live counts.
+
+    Each count is the number of active products the listing would show
+    if that option was toggled on, given the other selected filters.
+    """
+    tag_ids = [int(tag_id) for tag_id in tag_ids]
+    everything = load(FacetBitmap.ACTIVE).get(ACTIVE_VALUE, 0)
+    tag_bitmaps = load(FacetBitmap.TAG)
+    price_bitmaps = load(FacetBitmap.PRICE)
+    stock_bitmap = load(FacetBitmap.STOCK).get(STOCK_VALUE, 0)
+
+    selected_tags = everything
+    for tag_id in tag_ids:
+        selected_tags &= tag_bitmaps.get(str(tag_id), 0)
+    selected_price = price_bitmaps.get(price, 0) if price else -1
+    selected_stock = stock_bitmap if in_stock else -1
+
+    tags = []
+    for tag in ProductTag.objects.filter(active=True).order_by("name"):
+        count = popcount(
+            selected_tags
+            & selected_price
+            & selected_stock
+            & tag_bitmaps.get(str(tag.id), 0)
+        )
+        if count or tag.id in tag_ids:
+            tags.append({"tag": tag, "count": count, "selected": tag.id in tag_ids})
+
+    prices = []
+    for key, label, _, _ in PRICE_BUCKETS:
+        prices.append(
+            {
+                "key": key,
+                "label": label,
+                "count": popcount(
+                    selected_tags & selected_stock & price_bitmaps.get(key, 0)
+                ),
+                "selected": key == price,
+            }
+        )
+
+    return {
+        "tags": tags,
+        "prices": prices,
+        "in_stock": {
+            "count": popcount(selected_tags & selected_price & stock_bitmap),
+            "selected": bool(in_stock),
+        },
+    }
@@ -4,7 +4,7 @@ import logging
 from django.contrib.auth import authenticate
 from django.contrib.auth.forms import UserCreationForm as DjangoUserCreationForm
 from django.contrib.auth.forms import UsernameField
-from django.forms import inlineformset_factory
+from django.forms import BaseFormSet, formset_factory, inlineformset_factory
 
 from . import models, widgets
 from .models import Cart, ProductInCart
@@ -81,9 +81,56 @@ CartLineFormSet = inlineformset_factory(
 )
 
 
+class SessionCartLineForm(forms.Form):
+    product_id = forms.IntegerField(widget=forms.HiddenInput)
+    quantity = forms.IntegerField(min_value=0, widget=widgets.PlusMinusNumberInput())
+
+    def __init__(self, *args, product=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.product = product
+
+
+class BaseSessionCartLineFormSet(BaseFormSet):
+    """Formset over the ``(product, quantity)`` lines of a SessionCart"""
+
+    def __init__(self, *args, lines=(), **kwargs):
+        self.products = [product for product, _ in lines]
+        kwargs.setdefault(
+            "initial",
+            [
+                {"product_id": product.id, "quantity": quantity}
+                for product, quantity in lines
+            ],
+        )
+        super().__init__(*args, **kwargs)
+
+    def get_form_kwargs(self, index):
+        kwargs = super().get_form_kwargs(index)
+        if index is not None and index < len(self.products):
+            kwargs["product"] = self.products[index]
+        return kwargs
+
+    def quantities(self):
+        return {
+            form.cleaned_data["product_id"]: 0
+            if form.cleaned_data.get("DELETE")
+            else form.cleaned_data["quantity"]
+            for form in self.forms
+            if form.cleaned_data
+        }
+
+
+SessionCartLineFormSet = formset_factory(
+    SessionCartLineForm, formset=BaseSessionCartLineFormSet, extra=0, can_delete=True
+)
+
+
 class AddressSelectionForm(forms.Form):
     billing_address = forms.ModelChoiceField(queryset=None)
     shipping_address = forms.ModelChoiceField(queryset=None)
+    idempotency_key = forms.CharField(
+        max_length=64, required=False, widget=forms.HiddenInput
+    )
 
     def __init__(self, user, *args, **kwargs):
         super(AddressSelectionForm, self).__init__(*args, **kwargs)
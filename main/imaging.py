@@ -0,0 +1,291 @@
+import logging
+import math
+import os
+import time
+from io import BytesIO
+
+from PIL import Image
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from . import jobs
+from .models import ProductImage, ProductImageDerivative
+
+THUMBNAIL_SIZE = (300, 300)
+
+PIL_FORMATS = {
+    ProductImageDerivative.JPEG: "JPEG",
+    ProductImageDerivative.WEBP: "WEBP",
+}
+
+logger = logging.getLogger(__name__)
+
+
+class ImageTooLarge(jobs.PermanentError):
+    pass
+
+
+class ImageStats:
+    """Cost of processing one image.
+
+    Notes
+    -----
+    PIL allocates pixel buffers outside of the python allocator, so
+    ``peak_bytes`` is the largest sum of the buffers alive at the same
+    time rather than something tracemalloc could measure.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.seconds = None
+        self.source_size = None
+        self.decoded_size = None
+        self.peak_bytes = 0
+
+    def buffers(self, *images):
+        self.peak_bytes = max(self.peak_bytes, sum(map(buffer_bytes, images)))
+
+    def stop(self):
+        self.seconds = time.monotonic() - self.started
+        return self
+
+    def __str__(self):
+        return "source %dx%d, decoded %dx%d, peak %.1f MiB, %.3fs" % (
+            self.source_size
+            + self.decoded_size
+            + (self.peak_bytes / 2 ** 20, self.seconds or 0)
+        )
+
+
+def buffer_bytes(image):
+    """Bytes of pixel data Pillow holds for ``image`` once decoded"""
+    # one byte per pixel for 8 bit single band modes, two for 16 bit
+    # ones, and four for everything else: RGB is stored padded as RGBX
+    if image.mode in ("1", "L", "P"):
+        pixel_bytes = 1
+    elif image.mode.startswith("I;16"):
+        pixel_bytes = 2
+    else:
+        pixel_bytes = 4
+    return image.width * image.height * pixel_bytes
+
+
+def _encode(image, image_format):
+    output = BytesIO()
+    image.save(
+        output,
+        PIL_FORMATS[image_format],
+        quality=settings.PRODUCT_IMAGE_QUALITY,
+        optimize=image_format == ProductImageDerivative.JPEG,
+    )
+    return ContentFile(output.getvalue())
+
+
+def largest_needed_width(source_width):
+    needed = max(max(settings.PRODUCT_IMAGE_WIDTHS), THUMBNAIL_SIZE[0])
+    return min(source_width, needed)
+
+
+def decode(file, stats):
+    """Decode an image as RGB, at no more than the resolution we need.
+
+    JPEGs are decoded straight at a reduced scale (``draft``), other
+    formats are shrunk by an integer factor (``reduce``) right after
+    decoding. Images over PRODUCT_IMAGE_MAX_PIXELS, or whose pixels
+    would not fit in PRODUCT_IMAGE_MEMORY_BUDGET, are refused from their
+    header alone.
+    """
+    file.seek(0)
+    image = Image.open(file)
+    width, height = stats.source_size = image.size
+    if width * height > settings.PRODUCT_IMAGE_MAX_PIXELS:
+        raise ImageTooLarge(
+            "%dx%d is over %d pixels"
+            % (width, height, settings.PRODUCT_IMAGE_MAX_PIXELS)
+        )
+
+    needed = largest_needed_width(width)
+    if image.format == "JPEG":
+        image.draft("RGB", (needed, math.ceil(height * needed / width)))
+    if buffer_bytes(image) > settings.PRODUCT_IMAGE_MEMORY_BUDGET:
+        raise ImageTooLarge(
+            "decoding %dx%d needs %d bytes, the budget is %d"
+            % (
+                image.width,
+                image.height,
+                buffer_bytes(image),
+                settings.PRODUCT_IMAGE_MEMORY_BUDGET,
+            )
+        )
+
+    image.load()
+    stats.buffers(image)
+    if image.mode != "RGB":
+        converted = image.convert("RGB")
+        stats.buffers(image, converted)
+        image = converted
+    factor = image.width // needed
+    if factor >= 2:
+        reduced = image.reduce(factor)
+        stats.buffers(image, reduced)
+        image = reduced
+    stats.decoded_size = image.size
+    return image
+
+
+def make_thumbnail(product_image, image, stats):
+    """Render the 300x300 admin thumbnail (without saving the instance)"""
+    logger.info(
+        "Generating thumbnail for product %d",
+        product_image.product.id,
+    )
+    ratio = min(THUMBNAIL_SIZE[0] / image.width, THUMBNAIL_SIZE[1] / image.height, 1)
+    size = (max(1, round(image.width * ratio)), max(1, round(image.height * ratio)))
+    # resize() leaves the decoded image alone, the derivatives need it
+    thumbnail = image.resize(size, Image.LANCZOS)
+    stats.buffers(image, thumbnail)
+    # set save=False, otherwise it will run in an infinite loop
+    product_image.thumbnail.save(
+        os.path.basename(product_image.image.name),
+        _encode(thumbnail, ProductImageDerivative.JPEG),
+        save=False,
+    )
+
+
+def derivative_widths(original_width):
+    """Configured widths that do not upscale, and at least one width"""
+    widths = [w for w in settings.PRODUCT_IMAGE_WIDTHS if w < original_width]
+    if len(widths) < len(settings.PRODUCT_IMAGE_WIDTHS):
+        widths.append(min(original_width, max(settings.PRODUCT_IMAGE_WIDTHS)))
+    return widths
+
+
+def make_derivatives(product_image, image, stats):
+    """(Re)build every width/format derivative of a saved ProductImage.
+
+    Widths are produced from the largest down, each one resized from
+    the previous step. Sizes are computed from the original dimensions,
+    ``image`` may have been decoded at a reduced scale.
+    """
+    source_width, source_height = stats.source_size
+    base_name = os.path.splitext(os.path.basename(product_image.image.name))[0]
+    derivatives = []
+    previous = image
+    for width in sorted(derivative_widths(source_width), reverse=True):
+        height = max(1, round(source_height * width / source_width))
+        resized = previous.resize((width, height), Image.LANCZOS)
+        stats.buffers(image, previous, resized)
+        previous = resized
+        for image_format in PIL_FORMATS:
+            derivative = ProductImageDerivative(
+                image=product_image, format=image_format, width=width, height=height
+            )
+            derivative.file.save(
+                "%s-%d.%s" % (base_name, width, image_format),
+                _encode(resized, image_format),
+                save=False,
+            )
+            derivatives.append(derivative)
+
+    replace_derivatives(product_image, derivatives)
+    logger.info(
+        "Generated %d derivatives for product image %d",
+        len(derivatives),
+        product_image.id,
+    )
+    return derivatives
+
+
+def replace_derivatives(product_image, derivatives):
+    """Swap the derivative rows of an image, then drop orphaned files.
+
+    Files are content addressed and may be shared with other images (or
+    be the very files just saved), so only unreferenced ones go.
+    """
+    with transaction.atomic():
+        old = list(product_image.derivatives.all())
+        product_image.derivatives.all().delete()
+        ProductImageDerivative.objects.bulk_create(derivatives)
+    for derivative in old:
+        name = derivative.file.name
+        if not ProductImageDerivative.objects.filter(file=name).exists():
+            derivative.file.delete(save=False)
+
+
+def reuse_processed(product_image):
+    """Point an image at what was made for another one with the same file.
+
+    Returns False when no processed image shares the file, otherwise
+    the thumbnail and derivative rows are copied (without saving
+    ``product_image`` itself) and nothing has to be decoded.
+    """
+    source = (
+        ProductImage.objects.filter(
+            image=product_image.image.name, status=ProductImage.READY
+        )
+        .exclude(pk=product_image.pk)
+        .exclude(thumbnail__isnull=True)
+        .exclude(thumbnail="")
+        .prefetch_related("derivatives")
+        .first()
+    )
+    if source is None or not source.derivatives.all():
+        return False
+    product_image.thumbnail = source.thumbnail.name
+    replace_derivatives(
+        product_image,
+        [
+            ProductImageDerivative(
+                image=product_image,
+                format=derivative.format,
+                width=derivative.width,
+                height=derivative.height,
+                file=derivative.file.name,
+            )
+            for derivative in source.derivatives.all()
+        ],
+    )
+    logger.info(
+        "Reused the thumbnail and derivatives of product image %d for %d",
+        source.id,
+        product_image.id,
+    )
+    return True
+
+
+def process(product_image, thumbnail=True):
+    """Decode the original once, then make the thumbnail and derivatives.
+
+    Returns the ``ImageStats`` of the run, which are also logged.
+    """
+    stats = ImageStats()
+    product_image.image.open("rb")
+    try:
+        image = decode(product_image.image, stats)
+    finally:
+        product_image.image.close()
+    if thumbnail:
+        make_thumbnail(product_image, image, stats)
+    make_derivatives(product_image, image, stats)
+    stats.stop()
+    logger.info("Processed product image %d: %s", product_image.id, stats)
+    return stats
+
+
+def mark_failed(image_id):
+    ProductImage.objects.filter(pk=image_id).update(status=ProductImage.FAILED)
+
+
+@jobs.handler("process_product_image", on_failure=mark_failed)
+def process_product_image(image_id):
+    """Background job: thumbnail and derivatives of a new/changed image"""
+    try:
+        product_image = ProductImage.objects.select_related("product").get(pk=image_id)
+    except ProductImage.DoesNotExist:
+        logger.info("Product image %d is gone, nothing to process", image_id)
+        return
+    if not reuse_processed(product_image):
+        process(product_image)
+    product_image.status = ProductImage.READY
+    product_image.save(update_fields=["thumbnail", "status", "date_updated"])
@@ -0,0 +1,112 @@
+"""
+Invoice PDFs rendered once per version of an order.
+
+A rendered invoice is stored as ``invoices/<order id>/<version>.pdf``,
+the version being a digest of the update timestamps of the order and
+of its lines: editing either makes a new version, which is rendered on
+the next download (or by the ``render_invoice`` job queued when the
+order is paid) and replaces the stored one.
+
+Static files the invoice template links to are read from disk instead
+of being fetched over HTTP from the site itself.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max
+from django.template.loader import render_to_string
+from weasyprint import HTML, default_url_fetcher
+
+from . import jobs
+from .models import Order
+
+logger = logging.getLogger(__name__)
+
+DIRECTORY = "invoices"
+
+
+def url_fetcher(url):
+    path = urlsplit(url).path
+    if path.startswith(settings.STATIC_URL):
+        found = finders.find(path[len(settings.STATIC_URL) :])
+        if found:
+            with open(found, "rb") as static_file:
+                return {
+                    "string": static_file.read(),
+                    "mime_type": mimetypes.guess_type(found)[0],
+                }
+    return default_url_fetcher(url)
+
+
+def invoice_name(order):
+    """Storage name of the invoice of the current version of ``order``"""
+    lines = order.lines.aggregate(updated=Max("date_updated"), count=Count("id"))
+    version = repr((order.date_updated, lines["updated"], lines["count"]))
+    digest = hashlib.sha256(version.encode()).hexdigest()[:20]
+    return "%s/%d/%s.pdf" % (DIRECTORY, order.id, digest)
+
+
+def drop_older_versions(name):
+    """Delete the invoices of the same order stored before ``name``"""
+    directory, filename = os.path.split(name)
+    try:
+        stored = default_storage.get_modified_time(name)
+    except FileNotFoundError:
+        # already replaced by a newer version
+        return
+    for other in default_storage.listdir(directory)[1]:
+        path = os.path.join(directory, other)
+        try:
+            older = default_storage.get_modified_time(path) < stored
+        except FileNotFoundError:
+            # dropped by a concurrent render
+            continue
+        if other != filename and older:
+            default_storage.delete(path)
+
+
+def render(order, name):
+    """Render and store the invoice, dropping older versions of it.
+
+    A render that lost the race to store the same version drops its
+    copy, and one whose version was replaced while it ran leaves the
+    stored invoices alone.
+    """
+    html = render_to_string("invoice.html", {"order": order})
+    pdf = HTML(string=html, base_url="/", url_fetcher=url_fetcher).write_pdf()
+    if not default_storage.exists(name):
+        saved = default_storage.save(name, ContentFile(pdf))
+        if saved != name:
+            default_storage.delete(saved)
+    current = Order.objects.filter(pk=order.pk).first()
+    if current is not None and invoice_name(current) == name:
+        drop_older_versions(name)
+    logger.info("Rendered invoice %s (%d bytes)", name, len(pdf))
+    return pdf
+
+
+def open_invoice(order):
+    """The invoice PDF of ``order`` as a file, rendered only when missing"""
+    name = invoice_name(order)
+    if default_storage.exists(name):
+        return default_storage.open(name, "rb")
+    return ContentFile(render(order, name), name=os.path.basename(name))
+
+
+@jobs.handler("render_invoice")
+def render_invoice(order_id):
+    """Background job: have the invoice of a paid order ready for download"""
+    order = Order.objects.filter(pk=order_id).first()
+    if order is None:
+        logger.info("Order %d is gone, no invoice to render", order_id)
+        return
+    name = invoice_name(order)
+    if not default_storage.exists(name):
+        render(order, name)
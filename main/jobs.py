@@ -0,0 +1,164 @@
+"""
+A small job queue stored in the database.
+
+Jobs are ``Job`` rows carrying a kind and a JSON payload. Handlers are
+plain functions registered per kind with ``@handler``; the ``run_jobs``
+management command claims due jobs (``SELECT ... FOR UPDATE SKIP
+LOCKED`` where the database supports it, so several workers can share
+the table) and retries failures with an exponential backoff.
+"""
+import json
+import logging
+import os
+import socket
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+class PermanentError(Exception):
+    """Raised by a handler when retrying the job cannot help"""
+
+
+def handler(kind, on_failure=None):
+    """Register a function as the handler for jobs of ``kind``.
+
+    ``on_failure`` is called with the same payload once a job has used
+    all its attempts.
+    """
+
+    def register(func):
+        _handlers[kind] = (func, on_failure)
+        return func
+
+    return register
+
+
+def enqueue(kind, **payload):
+    if kind not in _handlers:
+        raise ValueError("No handler registered for job kind %r" % kind)
+    job = Job.objects.create(
+        kind=kind,
+        payload=json.dumps(payload),
+        max_attempts=settings.JOBS_MAX_ATTEMPTS,
+    )
+    logger.info("Queued job %s", job)
+    return job
+
+
+def worker_name():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def claim(worker, limit=1):
+    """Lock up to ``limit`` due jobs for ``worker`` and return them"""
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status=Job.QUEUED, run_after__lte=now)
+            .order_by("run_after", "id")
+            .values_list("id", flat=True)[:limit]
+        )
+        Job.objects.filter(id__in=ids, status=Job.QUEUED).update(
+            status=Job.RUNNING,
+            locked_by=worker,
+            locked_at=now,
+            attempts=F("attempts") + 1,
+        )
+    return list(Job.objects.filter(id__in=ids, locked_by=worker, locked_at=now))
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=settings.JOBS_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def run(job):
+    func, on_failure = _handlers[job.kind]
+    payload = json.loads(job.payload)
+    try:
+        func(**payload)
+    except Exception as e:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts or isinstance(e, PermanentError):
+            job.status = Job.FAILED
+            logger.error("Job %s failed for good after %d attempts", job, job.attempts)
+            if on_failure:
+                on_failure(**payload)
+        else:
+            job.status = Job.QUEUED
+            job.run_after = timezone.now() + retry_delay(job.attempts)
+            logger.warning("Job %s failed, retrying at %s", job, job.run_after)
+    else:
+        job.status = Job.DONE
+        logger.info("Job %s done", job)
+    job.locked_by = ""
+    job.locked_at = None
+    job.save(
+        update_fields=[
+            "status",
+            "run_after",
+            "last_error",
+            "locked_by",
+            "locked_at",
+            "date_updated",
+        ]
+    )
+    return job
+
+
+def run_pending(worker="inline", limit=None):
+    """Run due jobs in this process until there are none left"""
+    c = 0
+    while limit is None or c < limit:
+        jobs = claim(worker)
+        if not jobs:
+            break
+        run(jobs[0])
+        c += 1
+    return c
+
+
+def requeue_stale(older_than=None):
+    """Give back jobs held by workers that died while running them.
+
+    A job that already used all its attempts is failed instead, its
+    ``on_failure`` handler called, so a job that keeps killing its
+    worker is not retried forever.
+    """
+    if older_than is None:
+        older_than = timedelta(seconds=settings.JOBS_STALE_AFTER)
+    with transaction.atomic():
+        stale = list(
+            Job.objects.select_for_update(skip_locked=True).filter(
+                status=Job.RUNNING, locked_at__lt=timezone.now() - older_than
+            )
+        )
+        exhausted = [job for job in stale if job.attempts >= job.max_attempts]
+        retried = [job.id for job in stale if job.attempts < job.max_attempts]
+        requeued = Job.objects.filter(id__in=retried).update(
+            status=Job.QUEUED, locked_by="", locked_at=None
+        )
+        Job.objects.filter(id__in=[job.id for job in exhausted]).update(
+            status=Job.FAILED,
+            locked_by="",
+            locked_at=None,
+            last_error="Worker lost while running the job",
+            date_updated=timezone.now(),
+        )
+    for job in exhausted:
+        logger.error("Job %s failed for good after %d attempts", job, job.attempts)
+        on_failure = _handlers.get(job.kind, (None, None))[1]
+        if on_failure:
+            on_failure(**json.loads(job.payload))
+    return requeued
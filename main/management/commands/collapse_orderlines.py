@@ -0,0 +1,106 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min, Sum
+
+from main.models import Order, OrderLine
+
+
+class Command(BaseCommand):
+    help = (
+        "Collapses order lines of the same product and status into one line "
+        "with a quantity, a few orders at a time"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Orders collapsed per transaction",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="Seconds to pause between batches",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the lines that would be collapsed",
+        )
+
+    def duplicates(self, lines):
+        return (
+            lines.values("order", "product", "status")
+            .annotate(
+                lines=Count("id"),
+                keep=Min("id"),
+                quantity=Sum("quantity"),
+                quantity_sent=Sum("quantity_sent"),
+            )
+            .filter(lines__gt=1)
+            .order_by()
+        )
+
+    def collapse_batch(self, order_ids):
+        removed = 0
+        with transaction.atomic():
+            lines = OrderLine.objects.filter(order_id__in=order_ids)
+            # lock the lines of the batch before grouping them (FOR UPDATE
+            # cannot be combined with GROUP BY)
+            list(lines.select_for_update().values_list("id", flat=True))
+            for group in self.duplicates(lines):
+                OrderLine.objects.filter(pk=group["keep"]).update(
+                    quantity=group["quantity"],
+                    quantity_sent=group["quantity_sent"],
+                )
+                merged = OrderLine.objects.filter(
+                    order_id=group["order"],
+                    product_id=group["product"],
+                    status=group["status"],
+                ).exclude(pk=group["keep"])
+                # their units moved to the kept line, the product sales
+                # must not lose them through the per-line delete signal
+                removed += merged._raw_delete(merged.db)
+        return removed
+
+    def handle(self, *args, **options):
+        if options["dry_run"]:
+            groups = self.duplicates(OrderLine.objects.all())
+            self.stdout.write(
+                "Would collapse lines=%d into %d"
+                % (
+                    sum(group["lines"] for group in groups),
+                    len(groups),
+                )
+            )
+            return
+
+        self.stdout.write("Collapsing order lines")
+        started = time.monotonic()
+        last_id = 0
+        orders = removed = 0
+        while True:
+            order_ids = list(
+                Order.objects.filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", flat=True)[: options["batch_size"]]
+            )
+            if not order_ids:
+                break
+            removed += self.collapse_batch(order_ids)
+            orders += len(order_ids)
+            last_id = order_ids[-1]
+            if options["verbosity"] > 1:
+                self.stdout.write(
+                    "Orders processed=%d, lines removed=%d" % (orders, removed)
+                )
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        self.stdout.write(
+            "Orders processed=%d, lines removed=%d in %.1fs"
+            % (orders, removed, time.monotonic() - started)
+        )
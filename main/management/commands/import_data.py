@@ -18,6 +18,7 @@ class Command(BaseCommand):
         self.stdout.write("Importing Products")
         c = Counter()
         reader = csv.DictReader(options.pop("csvfile"))
+        image_field = ProductImage._meta.get_field("image")
 
         for row in reader:
             product, created = Product.objects.get_or_create(
@@ -36,10 +37,20 @@ class Command(BaseCommand):
             with open(
                 os.path.join(options["image_basedir"], row["image_filename"]), "rb"
             ) as f:
-                image = ProductImage(
-                    product=product, image=ImageFile(f, name=row["image_filename"])
+                # images are stored under the hash of their bytes, an
+                # import run again finds the ones it already saved
+                stored_name = image_field.storage.hashed_name(
+                    image_field.generate_filename(None, row["image_filename"]), f
                 )
-                image.save()
+                if ProductImage.objects.filter(
+                    product=product, image=stored_name
+                ).exists():
+                    c["images_duplicated"] += 1
+                else:
+                    image = ProductImage(
+                        product=product, image=ImageFile(f, name=row["image_filename"])
+                    )
+                    image.save()
                 c["images"] += 1
             product.save()
             c["products"] += 1
@@ -54,4 +65,7 @@ class Command(BaseCommand):
         self.stdout.write(
             "Tags processed=%d (created=%d)" % (c["tags"], c["tags_created"])
         )
-        self.stdout.write("Images processed=%d" % c["images"])
+        self.stdout.write(
+            "Images processed=%d (duplicates=%d)"
+            % (c["images"], c["images_duplicated"])
+        )
@@ -0,0 +1,113 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from main import caching
+from main.models import Cart, ProductInCart
+
+
+class Command(BaseCommand):
+    help = "Deletes abandoned carts and their lines, in small batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=180,
+            help="Delete open carts not updated for this many days",
+        )
+        parser.add_argument(
+            "--anonymous-days",
+            type=int,
+            default=14,
+            help="Delete open carts without a user not updated for this many days",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Carts deleted per transaction",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help="Seconds to pause between batches",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count what would be deleted",
+        )
+
+    def abandoned_carts(self, options):
+        # line edits move the date_updated of their cart too; submitted
+        # carts stay, their orders point at them
+        now = timezone.now()
+        return Cart.objects.filter(status=Cart.OPEN).filter(
+            Q(date_updated__lt=now - timedelta(days=options["days"]))
+            | Q(
+                user__isnull=True,
+                date_updated__lt=now - timedelta(days=options["anonymous_days"]),
+            )
+        )
+
+    def delete_batch(self, carts, batch_size):
+        with transaction.atomic():
+            # carts being used by another transaction are left for later
+            ids = list(
+                carts.select_for_update(skip_locked=True)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                return 0, 0
+            lines = ProductInCart.objects.filter(cart_id__in=ids)
+            # the carts go away with their lines, their summaries do not
+            # need the per-line signals a cascade would send
+            line_count = lines._raw_delete(lines.db)
+            Cart.objects.filter(id__in=ids).delete()
+        for cart_id in ids:
+            caching.invalidate_cart(cart_id)
+        return len(ids), line_count
+
+    def handle(self, *args, **options):
+        carts = self.abandoned_carts(options)
+        if options["dry_run"]:
+            self.stdout.write(
+                "Would delete carts=%d, lines=%d"
+                % (
+                    carts.count(),
+                    ProductInCart.objects.filter(cart__in=carts).count(),
+                )
+            )
+            return
+
+        self.stdout.write("Purging abandoned carts")
+        started = time.monotonic()
+        cart_count = line_count = 0
+        while True:
+            deleted_carts, deleted_lines = self.delete_batch(
+                carts, options["batch_size"]
+            )
+            if not deleted_carts:
+                break
+            cart_count += deleted_carts
+            line_count += deleted_lines
+            elapsed = time.monotonic() - started
+            if options["verbosity"] > 1:
+                self.stdout.write(
+                    "Deleted carts=%d, lines=%d (%.0f carts/s)"
+                    % (cart_count, line_count, cart_count / max(elapsed, 1e-6))
+                )
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            "Carts deleted=%d, lines=%d in %.1fs (%.0f carts/s)"
+            % (cart_count, line_count, elapsed, cart_count / max(elapsed, 1e-6))
+        )
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from main import facets
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the catalog facet bitmaps"
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rebuilding facet bitmaps")
+        c = facets.rebuild()
+        self.stdout.write("Bitmaps written=%d" % c)
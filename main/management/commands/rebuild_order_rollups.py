@@ -0,0 +1,63 @@
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from main.models import Order, OrderDailyRollup, ProductDailySales
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the daily order rollup and product sales of a range of "
+        "days from the orders"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--from",
+            dest="first_day",
+            type=date.fromisoformat,
+            help="First day to rebuild (YYYY-MM-DD), defaults to the first order",
+        )
+        parser.add_argument(
+            "--to",
+            dest="last_day",
+            type=date.fromisoformat,
+            help="Last day to rebuild (YYYY-MM-DD), defaults to today",
+        )
+        parser.add_argument(
+            "--batch-days",
+            type=int,
+            default=31,
+            help="Days rebuilt per transaction",
+        )
+
+    def handle(self, *args, **options):
+        first_day = options["first_day"]
+        if first_day is None:
+            first_order = Order.objects.order_by("date_created").first()
+            if first_order is None:
+                self.stdout.write("No orders")
+                return
+            first_day = timezone.localdate(first_order.date_created)
+        last_day = options["last_day"] or timezone.localdate()
+        if first_day > last_day:
+            raise CommandError("--from must not be after --to")
+
+        self.stdout.write(
+            "Rebuilding order rollups from %s to %s" % (first_day, last_day)
+        )
+        started = time.monotonic()
+        rows = 0
+        day = first_day
+        while day <= last_day:
+            batch_last = min(day + timedelta(days=options["batch_days"] - 1), last_day)
+            rows += OrderDailyRollup.objects.rebuild(day, batch_last)
+            rows += ProductDailySales.objects.rebuild(day, batch_last)
+            if options["verbosity"] > 1:
+                self.stdout.write("Rebuilt up to %s, rows=%d" % (batch_last, rows))
+            day = batch_last + timedelta(days=1)
+        self.stdout.write(
+            "Rollup rows=%d in %.1fs" % (rows, time.monotonic() - started)
+        )
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from main import search
+from main.models import Product, SearchTerm
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the product search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help="Drop the whole index before rebuilding it",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rebuilding search index")
+        if options["clear"]:
+            SearchTerm.objects.all().delete()
+        c = search.index_products(Product.objects.order_by("id"))
+        self.stdout.write(
+            "Products indexed=%d, terms=%d" % (c, SearchTerm.objects.count())
+        )
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import imaging
+from main.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = "Regenerates resized derivatives of product images"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--missing-only",
+            action="store_true",
+            help="Only process images that have no derivatives yet",
+        )
+        parser.add_argument(
+            "--product",
+            type=int,
+            action="append",
+            dest="products",
+            help="Restrict to the images of this product id (repeatable)",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("Regenerating image derivatives")
+        images = ProductImage.objects.select_related("product").order_by("id")
+        if options["missing_only"]:
+            images = images.filter(derivatives__isnull=True)
+        if options["products"]:
+            images = images.filter(product_id__in=options["products"])
+
+        started = time.monotonic()
+        c = 0
+        failed = 0
+        peak_bytes = 0
+        for product_image in images.iterator():
+            try:
+                stats = imaging.process(product_image, thumbnail=False)
+            except (OSError, ValueError, imaging.ImageTooLarge) as e:
+                failed += 1
+                self.stderr.write("Image %d failed: %s" % (product_image.id, e))
+                continue
+            if options["verbosity"] > 1:
+                self.stdout.write("Image %d: %s" % (product_image.id, stats))
+            peak_bytes = max(peak_bytes, stats.peak_bytes)
+            c += 1
+        self.stdout.write(
+            "Images processed=%d (failed=%d) in %.1fs, peak %.1f MiB"
+            % (c, failed, time.monotonic() - started, peak_bytes / 2 ** 20)
+        )
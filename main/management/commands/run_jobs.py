@@ -0,0 +1,65 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from main import jobs
+
+
+def run_job(job):
+    try:
+        jobs.run(job)
+    finally:
+        # every thread has its own connection, do not leak them
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Runs queued background jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.JOBS_CONCURRENCY,
+            help="Number of jobs run at the same time by this worker",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.JOBS_POLL_INTERVAL,
+            help="Seconds to wait when the queue is empty",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit as soon as the queue is empty",
+        )
+
+    def handle(self, *args, **options):
+        worker = jobs.worker_name()
+        concurrency = max(1, options["concurrency"])
+        self.stdout.write(
+            "Worker %s started with concurrency=%d" % (worker, concurrency)
+        )
+        c = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            try:
+                while True:
+                    close_old_connections()
+                    requeued = jobs.requeue_stale()
+                    if requeued:
+                        self.stdout.write("Requeued %d stale jobs" % requeued)
+                    claimed = jobs.claim(worker, limit=concurrency)
+                    if not claimed:
+                        if options["once"]:
+                            break
+                        time.sleep(options["poll_interval"])
+                        continue
+                    list(pool.map(run_job, claimed))
+                    c += len(claimed)
+            except KeyboardInterrupt:
+                self.stdout.write("Interrupted, finishing running jobs")
+        self.stdout.write("Jobs processed=%d" % c)
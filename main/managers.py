@@ -1,6 +1,26 @@
-from django.db import models
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+
+from django.apps import apps
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import (
+    Case,
+    Count,
+    DecimalField,
+    F,
+    OuterRef,
+    Subquery,
+    Sum,
+    When,
+)
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 
+from main import caching, stock
+
 
 class ProductTagManager(models.Manager):
     """Product Tag Manager
@@ -50,3 +70,281 @@ class UserManager(BaseUserManager):
         if extra_fields.get("is_superuser") is not True:
             raise ValueError("Superuser must have is_superuser=True.")
         return self._create_user(email, password, **extra_fields)
+
+
+class CartManager(models.Manager):
+    """Cart Manager
+
+    Notes
+    -----
+    Keeps the ``item_count`` and ``total`` summary columns of carts in
+    step with their lines, with atomic UPDATEs only.
+    """
+
+    def add_to_summary(self, cart_id, quantity, amount):
+        # a line edit is a cart edit, purge_carts goes by date_updated
+        return self.filter(pk=cart_id).update(
+            item_count=F("item_count") + quantity,
+            total=F("total") + amount,
+            date_updated=timezone.now(),
+        )
+
+    def recompute_summary(self, carts, **changes):
+        """Recompute the summary of a cart queryset from its lines
+
+        ``changes`` are more fields set by the same UPDATE.
+        """
+        lines = (
+            self.model._meta.get_field("productincart")
+            .related_model.objects.filter(cart=OuterRef("pk"))
+            .order_by()
+            .values("cart")
+        )
+        item_count = lines.annotate(c=Sum("quantity")).values("c")
+        total = lines.annotate(
+            t=Sum(
+                F("quantity") * F("product__price"),
+                output_field=DecimalField(max_digits=10, decimal_places=2),
+            )
+        ).values("t")
+        return carts.update(
+            item_count=Coalesce(Subquery(item_count), 0),
+            total=Coalesce(Subquery(total), Decimal("0")),
+            **changes,
+        )
+
+
+class OrderManager(models.Manager):
+    """Order Manager"""
+
+    def complete(self, order_ids):
+        """Mark DONE the orders among ``order_ids`` with no line left to send.
+
+        One UPDATE for any number of orders, with the outcome of saving
+        each of their lines. Returns the number of orders completed.
+        There is no post_save, the daily rollup is moved here instead.
+        """
+        OrderLine = self.model._meta.get_field("lines").related_model
+        rollups = apps.get_model("main", "OrderDailyRollup").objects
+        pending = OrderLine.objects.filter(
+            order_id__in=order_ids, status__lt=OrderLine.SENT
+        ).values("order_id")
+        with transaction.atomic(savepoint=False):
+            ids = list(
+                self.filter(pk__in=order_ids)
+                .exclude(status=self.model.DONE)
+                .exclude(pk__in=pending)
+                .select_for_update()
+                .values_list("id", flat=True)
+            )
+            if not ids:
+                return 0
+            orders = self.filter(pk__in=ids)
+            changes = Counter()
+            for (day, status, country), count in rollups.order_counts(orders).items():
+                changes[day, status, country] -= count
+                changes[day, self.model.DONE, country] += count
+            orders.update(status=self.model.DONE, date_updated=timezone.now())
+            rollups.add(changes)
+        return len(ids)
+
+
+class OrderLineQuerySet(models.QuerySet):
+    def transition(self, status):
+        """Move every line to ``status`` with one UPDATE.
+
+        The orders of the lines are completed afterwards in one more
+        statement, see ``OrderManager.complete``. Cancelling lines puts
+        their unsent units back in stock and takes them off the sales.
+        """
+        order_ids = list(self.order_by().values_list("order_id", flat=True).distinct())
+        changes = {"status": status, "date_updated": timezone.now()}
+        if status == self.model.SENT:
+            changes["quantity_sent"] = F("quantity")
+        sales = apps.get_model("main", "ProductDailySales").objects
+        pending = F("quantity") - F("quantity_sent")
+        with transaction.atomic():
+            # unsent units stop counting as sold, or count again
+            if status == self.model.CANCELLED:
+                cancelled = self.exclude(status=self.model.CANCELLED)
+                sold = sales.line_sales(cancelled, pending)
+                sales.add({key: -units for key, units in sold.items()})
+                stock.release(
+                    dict(
+                        cancelled.order_by()
+                        .values("product_id")
+                        .annotate(units=Sum(pending))
+                        .values_list("product_id", "units")
+                    )
+                )
+            else:
+                restored = self.filter(status=self.model.CANCELLED)
+                sales.add(sales.line_sales(restored, pending))
+            count = self.update(**changes)
+            self.model._meta.get_field("order").related_model.objects.complete(
+                order_ids
+            )
+        return count
+
+
+def increment(manager, field, change, **lookup):
+    """Add ``change`` to ``field`` of the row matching ``lookup``, or create it
+
+    Safe against concurrent calls: the row is incremented with a single
+    UPDATE, and losing the race to create it falls back to the increment.
+    """
+    rows = manager.filter(**lookup)
+    if rows.update(**{field: F(field) + change}):
+        return
+    try:
+        with transaction.atomic():
+            manager.create(**{field: change}, **lookup)
+    except IntegrityError:
+        rows.update(**{field: F(field) + change})
+
+
+class OrderDailyRollupManager(models.Manager):
+    """Order Daily Rollup Manager
+
+    Notes
+    -----
+    Counts are moved by ``add`` as orders are created, change status or
+    are deleted, and recomputed from the orders table by ``rebuild``.
+    The changes are applied once the transaction that made them commits,
+    so concurrent checkouts do not queue on the lock of the shared row
+    of the day; a change lost to a crash in between is put right by
+    ``rebuild_order_rollups``.
+    """
+
+    def add(self, changes):
+        """Apply ``{(day, status, shipping country): change}`` on commit"""
+        changes = {key: change for key, change in changes.items() if change}
+        if changes:
+            transaction.on_commit(lambda: self.apply(changes))
+
+    def apply(self, changes):
+        """Apply ``{(day, status, shipping country): change}`` to the counts"""
+        for (day, status, country), change in sorted(changes.items()):
+            if change:
+                increment(
+                    self,
+                    "count",
+                    change,
+                    day=day,
+                    status=status,
+                    shipping_country=country,
+                )
+
+    def order_counts(self, orders):
+        """``{(day, status, shipping country): orders}`` of an Order queryset"""
+        rows = (
+            orders.order_by()
+            .annotate(day=TruncDate("date_created"))
+            .values("day", "status", "shipping_country")
+            .annotate(count=Count("id"))
+            .values_list("day", "status", "shipping_country", "count")
+        )
+        return {(day, status, country): count for day, status, country, count in rows}
+
+    def rebuild(self, first_day, last_day):
+        """Recompute the rows of the days from ``first_day`` to ``last_day``"""
+        Order = apps.get_model("main", "Order")
+        with transaction.atomic():
+            self.filter(day__range=(first_day, last_day)).delete()
+            counts = self.order_counts(
+                Order.objects.filter(date_created__date__range=(first_day, last_day))
+            )
+            self.bulk_create(
+                self.model(
+                    day=day, status=status, shipping_country=country, count=count
+                )
+                for (day, status, country), count in counts.items()
+            )
+        return len(counts)
+
+
+class ProductDailySalesManager(models.Manager):
+    """Product Daily Sales Manager
+
+    Notes
+    -----
+    Units ordered per product and day, moved by ``add`` as order lines
+    are created, change quantity or are cancelled, and recomputed by
+    ``rebuild``. A cancelled line only counts the units sent before it
+    was cancelled. Like the daily order rollup, changes are applied
+    after the transaction commits. ``top`` ranks products from these
+    rows alone, a few per product and day, never from the order lines.
+    """
+
+    def add(self, changes):
+        """Apply ``{(day, product id): units}`` on commit"""
+        changes = {key: change for key, change in changes.items() if change}
+        if changes:
+            transaction.on_commit(lambda: self.apply(changes))
+
+    def apply(self, changes):
+        """Apply ``{(day, product id): units}`` to the sales"""
+        for (day, product_id), change in sorted(changes.items()):
+            if change:
+                increment(self, "quantity", change, day=day, product_id=product_id)
+
+    def line_sales(self, lines, units=None):
+        """``{(day, product id): units}`` of an OrderLine queryset
+
+        ``units`` is the expression summed, the units sold by default.
+        """
+        if units is None:
+            cancelled = lines.model.CANCELLED
+            units = Case(
+                When(status=cancelled, then=F("quantity_sent")),
+                default=F("quantity"),
+            )
+        rows = (
+            lines.order_by()
+            .annotate(day=TruncDate("order__date_created"))
+            .values("day", "product_id")
+            .annotate(units=Sum(units))
+            .values_list("day", "product_id", "units")
+        )
+        return {(day, product_id): units for day, product_id, units in rows}
+
+    def rebuild(self, first_day, last_day):
+        """Recompute the rows of the days from ``first_day`` to ``last_day``"""
+        OrderLine = apps.get_model("main", "OrderLine")
+        with transaction.atomic():
+            self.filter(day__range=(first_day, last_day)).delete()
+            sales = self.line_sales(
+                OrderLine.objects.filter(
+                    order__date_created__date__range=(first_day, last_day)
+                )
+            )
+            self.bulk_create(
+                self.model(day=day, product_id=product_id, quantity=units)
+                for (day, product_id), units in sales.items()
+            )
+        return len(sales)
+
+    def top(self, days, limit=10, active_only=False):
+        """The ``limit`` best selling ``(product id, units)`` of the last days.
+
+        Rankings are cached for ``BESTSELLERS_CACHE_TIMEOUT`` seconds,
+        under the catalog version so products taken off sale drop out.
+        """
+        today = timezone.localdate()
+
+        def rank():
+            sales = self.filter(day__gt=today - timedelta(days=days))
+            if active_only:
+                sales = sales.filter(product__active=True)
+            return list(
+                sales.values("product_id")
+                .annotate(units=Sum("quantity"))
+                .order_by("-units", "product_id")
+                .values_list("product_id", "units")[:limit]
+            )
+
+        return caching.get_or_set(
+            caching.catalog_key("bestsellers", today, days, limit, active_only),
+            rank,
+            settings.BESTSELLERS_CACHE_TIMEOUT,
+        )
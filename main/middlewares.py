@@ -1,5 +1,44 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+from main import caching, carts
 from main.models import Cart
 
+logger = logging.getLogger(__name__)
+
+
+def get_cart(request):
+    """
+    Return the cart of the session, or None
+
+    Notes
+    -----
+    The cart is read from a short-lived cache entry before the database.
+    A ``cart_id`` left in the session for a cart that no longer exists
+    is removed from it. Without a ``cart_id``, a non-empty session cart
+    is returned.
+    """
+    cart_id = request.session.get("cart_id")
+    if cart_id is None:
+        if carts.SESSION_KEY in request.session:
+            session_cart = carts.SessionCart(request.session)
+            if not session_cart.is_empty():
+                return session_cart
+        return None
+    key = caching.cart_key(cart_id)
+    cart = cache.get(key)
+    if cart is None:
+        cart = Cart.objects.filter(id=cart_id).first()
+        if cart is None:
+            logger.info("Dropping stale cart_id %s from the session", cart_id)
+            del request.session["cart_id"]
+            return None
+        cache.set(key, cart, settings.CART_CACHE_TIMEOUT)
+    return cart
+
 
 def cart_middleware(get_response):
     """
@@ -9,6 +48,8 @@ def cart_middleware(get_response):
     -----
     Automatically connects carts to HTTP requests.
     This will help avoid repeating identical calls in different places.
+    The cart is attached lazily, requests that never look at it do not
+    pay for it.
 
     Parameters
     ----------
@@ -20,12 +61,7 @@ def cart_middleware(get_response):
     """
 
     def middleware(request):
-        if "cart_id" in request.session:
-            cart_id = request.session["cart_id"]
-            cart = Cart.objects.get(id=cart_id)
-            request.cart = cart
-        else:
-            request.cart = None
+        request.cart = SimpleLazyObject(lambda: get_cart(request))
         response = get_response(request)
         return response
 
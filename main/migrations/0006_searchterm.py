@@ -0,0 +1,26 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_order_last_spoken_to'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(db_index=True, max_length=32)),
+                ('weight', models.PositiveIntegerField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='main.Product')),
+            ],
+            options={
+                'unique_together': {('term', 'product')},
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_searchterm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetBitmap',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(choices=[('active', 'Active'), ('stock', 'In stock'), ('price', 'Price'), ('tag', 'Tag')], max_length=16)),
+                ('value', models.CharField(max_length=48)),
+                ('bits', models.BinaryField(default=b'')),
+            ],
+            options={
+                'unique_together': {('facet', 'value')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_facetbitmap'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductImageDerivative',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('format', models.CharField(choices=[('jpeg', 'JPEG'), ('webp', 'WebP')], max_length=8)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('file', models.ImageField(upload_to='product-derivatives')),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='main.ProductImage')),
+            ],
+            options={
+                'ordering': ('format', 'width'),
+                'unique_together': {('image', 'format', 'width')},
+            },
+        ),
+    ]
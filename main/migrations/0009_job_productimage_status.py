@@ -0,0 +1,49 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:23
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def mark_existing_images_ready(apps, schema_editor):
+    ProductImage = apps.get_model('main', 'ProductImage')
+    ProductImage.objects.exclude(thumbnail='').exclude(
+        thumbnail__isnull=True
+    ).update(status=20)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_productimagederivative'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='status',
+            field=models.IntegerField(choices=[(10, 'Pending'), (20, 'Ready'), (30, 'Failed')], default=10),
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('kind', models.CharField(max_length=64)),
+                ('payload', models.TextField(default='{}')),
+                ('status', models.IntegerField(choices=[(10, 'Queued'), (20, 'Running'), (30, 'Done'), (40, 'Failed')], default=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=5)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_by', models.CharField(blank=True, max_length=64)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'index_together': {('status', 'run_after')},
+            },
+        ),
+        migrations.RunPython(
+            mark_existing_images_ready, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:27
+
+from django.db import migrations, models
+import main.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_job_productimage_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(storage=main.storage.ContentAddressedStorage(), upload_to='product-images'),
+        ),
+        migrations.AlterField(
+            model_name='productimage',
+            name='thumbnail',
+            field=models.ImageField(null=True, storage=main.storage.ContentAddressedStorage(), upload_to='product-thumbnails'),
+        ),
+        migrations.AlterField(
+            model_name='productimagederivative',
+            name='file',
+            field=models.ImageField(storage=main.storage.ContentAddressedStorage(), upload_to='product-derivatives'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:29
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_cart_summary(apps, schema_editor):
+    Cart = apps.get_model('main', 'Cart')
+    ProductInCart = apps.get_model('main', 'ProductInCart')
+    lines = ProductInCart.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    item_count = lines.annotate(c=Sum('quantity')).values('c')
+    total = lines.annotate(
+        t=Sum(
+            F('quantity') * F('product__price'),
+            output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        )
+    ).values('t')
+    Cart.objects.update(
+        item_count=Coalesce(Subquery(item_count), 0),
+        total=Coalesce(Subquery(total), Decimal('0')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_content_addressed_images'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.RunPython(backfill_cart_summary, migrations.RunPython.noop),
+    ]
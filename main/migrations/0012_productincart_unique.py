@@ -0,0 +1,36 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:30
+
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    ProductInCart = apps.get_model('main', 'ProductInCart')
+    duplicates = (
+        ProductInCart.objects.values('cart', 'product')
+        .annotate(lines=Count('id'), keep=Min('id'), quantity=Sum('quantity'))
+        .filter(lines__gt=1)
+        .order_by()
+    )
+    for duplicate in duplicates.iterator():
+        ProductInCart.objects.filter(pk=duplicate['keep']).update(
+            quantity=duplicate['quantity']
+        )
+        ProductInCart.objects.filter(
+            cart=duplicate['cart'], product=duplicate['product']
+        ).exclude(pk=duplicate['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_cart_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='productincart',
+            unique_together={('cart', 'product')},
+        ),
+    ]
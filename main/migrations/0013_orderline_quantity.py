@@ -0,0 +1,31 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:34
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_sent_units(apps, schema_editor):
+    OrderLine = apps.get_model('main', 'OrderLine')
+    OrderLine.objects.filter(status=30).update(quantity_sent=F('quantity'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_productincart_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderline',
+            name='quantity',
+            field=models.PositiveIntegerField(default=1, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AddField(
+            model_name='orderline',
+            name='quantity_sent',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_sent_units, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_orderline_quantity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='cart',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to='main.Cart'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(fields=('cart',), name='order_unique_cart'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(_negated=True, idempotency_key=''), fields=('user', 'idempotency_key'), name='order_unique_idempotency_key'),
+        ),
+    ]
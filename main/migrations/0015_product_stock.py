@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_order_cart_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='stock',
+            field=models.PositiveIntegerField(blank=True, help_text='Units available, leave empty to set in stock by hand', null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:40
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def backfill_order_rollups(apps, schema_editor):
+    Order = apps.get_model('main', 'Order')
+    OrderDailyRollup = apps.get_model('main', 'OrderDailyRollup')
+    rows = (
+        Order.objects.order_by()
+        .annotate(day=TruncDate('date_created'))
+        .values('day', 'status', 'shipping_country')
+        .annotate(count=Count('id'))
+    )
+    OrderDailyRollup.objects.bulk_create(
+        OrderDailyRollup(**row) for row in rows.iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_product_stock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderDailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.IntegerField(choices=[(10, 'New'), (20, 'Paid'), (30, 'Done')])),
+                ('shipping_country', models.CharField(max_length=3)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('day', 'status', 'shipping_country')},
+            },
+        ),
+        migrations.RunPython(backfill_order_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:42
+
+from django.db import migrations, models
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def backfill_product_sales(apps, schema_editor):
+    OrderLine = apps.get_model('main', 'OrderLine')
+    ProductDailySales = apps.get_model('main', 'ProductDailySales')
+    rows = (
+        OrderLine.objects.order_by()
+        .annotate(day=TruncDate('order__date_created'))
+        .values('day', 'product_id')
+        .annotate(quantity=Sum('quantity'))
+    )
+    ProductDailySales.objects.bulk_create(
+        ProductDailySales(**row) for row in rows.iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_order_daily_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='main.Product')),
+            ],
+            options={
+                'verbose_name_plural': 'Product daily sales',
+                'unique_together': {('day', 'product')},
+            },
+        ),
+        migrations.RunPython(backfill_product_sales, migrations.RunPython.noop),
+    ]
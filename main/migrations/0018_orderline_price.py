@@ -0,0 +1,37 @@
+# Generated by Django 2.2.16 on 2026-10-17 03:52
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_orderline_price(apps, schema_editor):
+    # the price at order time was never recorded, the current one is the
+    # best there is for existing lines
+    OrderLine = apps.get_model('main', 'OrderLine')
+    Product = apps.get_model('main', 'Product')
+    OrderLine.objects.update(
+        price=Subquery(
+            Product.objects.filter(pk=OuterRef('product')).values('price')[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_product_daily_sales'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderline',
+            name='price',
+            field=models.DecimalField(decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.RunPython(backfill_orderline_price, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderline',
+            name='price',
+            field=models.DecimalField(decimal_places=2, max_digits=6),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.16 on 2026-10-17 04:22
+
+from django.db import migrations, models
+import main.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_order_analytics_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(db_index=True, storage=main.storage.ContentAddressedStorage(), upload_to='product-images'),
+        ),
+    ]
@@ -3,10 +3,23 @@ import logging
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from main.managers import ActiveManager, ProductTagManager, UserManager
+from main.managers import (
+    ActiveManager,
+    CartManager,
+    OrderDailyRollupManager,
+    OrderLineQuerySet,
+    OrderManager,
+    ProductDailySalesManager,
+    ProductTagManager,
+    UserManager,
+)
+from main import caching, stock
+from main.storage import content_addressed_storage
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +36,43 @@ class TimeStampedModel(models.Model):
     class Meta:
         abstract = True
 
+    # Remember what was loaded from the database, so that signal
+    # handlers can tell which fields a save actually changed
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            field.attname: instance._tracked_value(field)
+            for field in cls._meta.concrete_fields
+            if field.attname in field_names
+        }
+        return instance
+
+    def _tracked_value(self, field):
+        value = getattr(self, field.attname)
+        if isinstance(field, models.FileField):
+            return value.name
+        return value
+
+    def loaded_value(self, field_name, default=None):
+        field = self._meta.get_field(field_name)
+        return getattr(self, "_loaded_values", {}).get(field.attname, default)
+
+    def has_changed(self, field_name):
+        """True if the field differs from the stored row (or there is none)"""
+        field = self._meta.get_field(field_name)
+        loaded = getattr(self, "_loaded_values", {})
+        if field.attname not in loaded:
+            return True
+        return self._tracked_value(field) != loaded[field.attname]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_values = {
+            field.attname: self._tracked_value(field)
+            for field in self._meta.concrete_fields
+        }
+
 
 class User(AbstractUser):
     username = None
@@ -80,32 +130,233 @@ class Product(TimeStampedModel):
     slug = models.SlugField(max_length=48)
     active = models.BooleanField(default=True)
     in_stock = models.BooleanField(default=True)
+    stock = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text=_("Units available, leave empty to set in stock by hand"),
+    )
 
     objects = ActiveManager()
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # checkouts count stock down with UPDATEs (see main.stock), a full
+        # save of an instance loaded before one must not put units back
+        if (
+            not self._state.adding
+            and kwargs.get("update_fields") is None
+            and not self.has_changed("stock")
+        ):
+            kept = {"stock"} if self.stock is None else {"stock", "in_stock"}
+            # and what it holds of them may be stale: read them back, so
+            # the instance and the post_save receivers (facets) see the
+            # stored values
+            self.refresh_from_db(fields=sorted(kept))
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in kept
+            ]
+        if self.stock is not None:
+            self.in_stock = self.stock > 0
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name = _("Product")
         verbose_name_plural = _("Products")
 
 
+class SearchTerm(models.Model):
+    """Search Term Model
+
+    Notes
+    -----
+    One row of the product search inverted index: a normalized term
+    and the weight it carries for a product. Maintained by
+    ``main.search``, never edited by hand.
+    """
+
+    term = models.CharField(max_length=32, db_index=True)
+    product = models.ForeignKey(
+        to=Product, on_delete=models.CASCADE, related_name="search_terms"
+    )
+    weight = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f"{self.term} -> {self.product_id}"
+
+    class Meta:
+        unique_together = (("term", "product"),)
+
+
+class FacetBitmap(models.Model):
+    """Facet Bitmap Model
+
+    Notes
+    -----
+    The set of product ids sharing a facet value, stored as a bitmap
+    (bit ``n`` set means product ``n`` is in the set). Catalog facet
+    counts are intersections of these bitmaps, see ``main.facets``.
+    """
+
+    ACTIVE = "active"
+    STOCK = "stock"
+    PRICE = "price"
+    TAG = "tag"
+    FACETS = ((ACTIVE, "Active"), (STOCK, "In stock"), (PRICE, "Price"), (TAG, "Tag"))
+
+    facet = models.CharField(max_length=16, choices=FACETS)
+    value = models.CharField(max_length=48)
+    bits = models.BinaryField(default=b"")
+
+    def __str__(self):
+        return f"{self.facet}={self.value}"
+
+    class Meta:
+        unique_together = (("facet", "value"),)
+
+
 class ProductImage(TimeStampedModel):
-    """Product Image Model"""
+    """Product Image Model
+
+    Notes
+    -----
+    The thumbnail and derivatives are made by a background job after the
+    image is saved; until then the image is ``PENDING``. Files are named
+    after their content, so images with the same bytes share their files
+    and the job reuses what was made for the first one.
+    """
+
+    PENDING = 10
+    READY = 20
+    FAILED = 30
+    STATUSES = ((PENDING, "Pending"), (READY, "Ready"), (FAILED, "Failed"))
 
     product = models.ForeignKey(to=Product, on_delete=models.CASCADE)
-    image = models.ImageField(upload_to="product-images")
-    thumbnail = models.ImageField(upload_to="product-thumbnails", null=True)
+    # indexed: uploads with the same content share a name, see
+    # main.imaging.reuse_processed
+    image = models.ImageField(
+        upload_to="product-images", storage=content_addressed_storage, db_index=True
+    )
+    thumbnail = models.ImageField(
+        upload_to="product-thumbnails", storage=content_addressed_storage, null=True
+    )
+    status = models.IntegerField(choices=STATUSES, default=PENDING)
 
     def __str__(self):
         return f"{self.product.id} + | + {self.product.name}"
 
+    @property
+    def is_pending(self):
+        return self.status == ProductImage.PENDING
+
+    @property
+    def thumbnail_url(self):
+        if self.thumbnail:
+            return self.thumbnail.url
+        return self.image.url
+
+    def srcset(self, image_format):
+        return ", ".join(
+            f"{derivative.file.url} {derivative.width}w"
+            for derivative in self.derivatives.all()
+            if derivative.format == image_format
+        )
+
+    @property
+    def jpeg_srcset(self):
+        return self.srcset(ProductImageDerivative.JPEG)
+
+    @property
+    def webp_srcset(self):
+        return self.srcset(ProductImageDerivative.WEBP)
+
+    @property
+    def fallback_url(self):
+        jpegs = [
+            derivative
+            for derivative in self.derivatives.all()
+            if derivative.format == ProductImageDerivative.JPEG
+        ]
+        if jpegs:
+            return jpegs[-1].file.url
+        return self.image.url
+
     class Meta:
         verbose_name = _("Product Image")
         verbose_name_plural = _("Product Images")
 
 
+class ProductImageDerivative(TimeStampedModel):
+    """Product Image Derivative Model
+
+    Notes
+    -----
+    A resized copy of a ``ProductImage`` in a web format, used to build
+    ``srcset`` attributes. Generated by ``main.imaging``.
+    """
+
+    JPEG = "jpeg"
+    WEBP = "webp"
+    FORMATS = ((JPEG, "JPEG"), (WEBP, "WebP"))
+
+    image = models.ForeignKey(
+        to=ProductImage, on_delete=models.CASCADE, related_name="derivatives"
+    )
+    format = models.CharField(max_length=8, choices=FORMATS)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    file = models.ImageField(
+        upload_to="product-derivatives", storage=content_addressed_storage
+    )
+
+    def __str__(self):
+        return f"{self.image_id} {self.format} {self.width}w"
+
+    class Meta:
+        ordering = ("format", "width")
+        unique_together = (("image", "format", "width"),)
+
+
+class Job(TimeStampedModel):
+    """Job Model
+
+    Notes
+    -----
+    A unit of background work stored in the database and run by the
+    ``run_jobs`` worker command, see ``main.jobs``.
+    """
+
+    QUEUED = 10
+    RUNNING = 20
+    DONE = 30
+    FAILED = 40
+    STATUSES = (
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+
+    kind = models.CharField(max_length=64)
+    payload = models.TextField(default="{}")
+    status = models.IntegerField(choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.kind} #{self.id}"
+
+    class Meta:
+        index_together = (("status", "run_after"),)
+
+
 class Address(TimeStampedModel):
     SUPPORTED_COUNTRIES = (
         ("in", "India"),
@@ -136,20 +387,120 @@ class Address(TimeStampedModel):
 
 
 class Cart(TimeStampedModel):
+    """Cart Model
+
+    Notes
+    -----
+    ``item_count`` and ``total`` summarize the lines of the cart. They
+    are kept up to date by ``ProductInCart`` signals (and when a product
+    price changes), so showing them never queries the lines.
+    """
+
     OPEN = 10
     SUBMITTED = 20
     STATUSES = ((OPEN, "Open"), (SUBMITTED, "Submitted"))
 
     user = models.ForeignKey(to=User, on_delete=models.CASCADE, blank=True, null=True)
     status = models.IntegerField(choices=STATUSES, default=OPEN)
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    total = models.DecimalField(
+        max_digits=10, decimal_places=2, default=0, editable=False
+    )
+
+    objects = CartManager()
+
+    SUMMARY_FIELDS = ("item_count", "total")
+
+    def save(self, *args, **kwargs):
+        # the summary is only written by CartManager, a full save of an
+        # instance loaded before the last line change must not undo it
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.SUMMARY_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    def refresh_summary(self):
+        self.refresh_from_db(fields=self.SUMMARY_FIELDS)
+
+    def add_product(self, product, quantity=1):
+        """Add units of a product to the cart, safe against concurrent adds.
+
+        The line is incremented with a single UPDATE, or created when
+        there is none yet; losing the race to create it (unique cart and
+        product) falls back to the increment.
+        """
+        lines = ProductInCart.objects.filter(cart=self, product=product)
+        increment = {
+            "quantity": F("quantity") + quantity,
+            "date_updated": timezone.now(),
+        }
+        if not lines.update(**increment):
+            try:
+                with transaction.atomic():
+                    # the post_save signal updates the summary
+                    ProductInCart.objects.create(
+                        cart=self, product=product, quantity=quantity
+                    )
+            except IntegrityError:
+                lines.update(**increment)
+            else:
+                self.refresh_summary()
+                return
+        Cart.objects.add_to_summary(self.id, quantity, quantity * product.price)
+        caching.invalidate_cart(self.id)
+        self.refresh_summary()
+
+    def merge(self, other):
+        """Move the lines of ``other`` into this cart, then delete ``other``.
+
+        Quantities of products in both carts are summed. This runs a
+        fixed number of statements in one transaction, however many
+        lines there are.
+        """
+        with transaction.atomic():
+            other_lines = ProductInCart.objects.filter(cart=other)
+            overlapping = ProductInCart.objects.filter(
+                cart=self, product__in=other_lines.values("product")
+            )
+            overlapping.update(
+                quantity=F("quantity")
+                + models.Subquery(
+                    other_lines.filter(product=models.OuterRef("product")).values(
+                        "quantity"
+                    )[:1]
+                ),
+                date_updated=timezone.now(),
+            )
+            merged = other_lines.filter(
+                product__in=ProductInCart.objects.filter(cart=self).values("product")
+            )
+            # other is deleted below, its summary does not need the
+            # per-line signals
+            merged._raw_delete(merged.db)
+            other_lines.update(cart=self, date_updated=timezone.now())
+            other.delete()
+            Cart.objects.recompute_summary(
+                Cart.objects.filter(pk=self.pk), date_updated=timezone.now()
+            )
+        caching.invalidate_cart(self.id)
+        self.refresh_summary()
 
     def is_empty(self):
-        return self.productincart_set.all().count() == 0
+        return self.item_count == 0
 
     def count(self):
-        return sum(i.quantity for i in self.productincart_set.all())
+        return self.item_count
 
-    def create_order(self, billing_address, shipping_address):
+    def create_order(self, billing_address, shipping_address, idempotency_key=""):
+        """Turn the cart into an order, at most once.
+
+        The cart row is locked for the few statements this takes. If the
+        cart already became an order (a retried or concurrent checkout),
+        that order is returned; a cart submitted any other way is refused.
+        """
         if not self.user:
             raise ValidationError("Cannot create order without user")
 
@@ -162,6 +513,8 @@ class Cart(TimeStampedModel):
         )
         order_data = {
             "user": self.user,
+            "cart": self,
+            "idempotency_key": idempotency_key,
             "billing_name": billing_address.name,
             "billing_address1": billing_address.address1,
             "billing_address2": billing_address.address2,
@@ -175,16 +528,43 @@ class Cart(TimeStampedModel):
             "shipping_city": shipping_address.city,
             "shipping_country": shipping_address.country,
         }
-        order = Order.objects.create(**order_data)
-        c = 0
-        for product in self.productincart_set.all():
-            for item in range(product.quantity):
-                order_line_data = {"order": order, "product": product.product}
-                order_line = OrderLine.objects.create(**order_line_data)
-                c += 1
-            logger.info("Created order with id=%d and lines_count=%d", order.id, c)
-        self.status = Cart.SUBMITTED
-        self.save()
+        with transaction.atomic():
+            status = (
+                Cart.objects.select_for_update()
+                .values_list("status", flat=True)
+                .get(pk=self.pk)
+            )
+            order = Order.objects.filter(cart=self).first()
+            if order is not None:
+                logger.info("Cart %d was already ordered as %d", self.id, order.id)
+                return order
+            if status != Cart.OPEN:
+                raise ValidationError("This cart has already been submitted")
+
+            product_lines = list(
+                self.productincart_set.select_related("product").order_by("id")
+            )
+            # raises OutOfStock, undoing the units already taken
+            stock.reserve({line.product_id: line.quantity for line in product_lines})
+            order = Order.objects.create(**order_data)
+            # bulk_create sends no post_save: new lines never complete an
+            # order, orderline_to_order_status would not do anything, but
+            # their sales have to be counted here
+            lines = OrderLine.objects.bulk_create(
+                OrderLine(
+                    order=order,
+                    product_id=product_in_cart.product_id,
+                    quantity=product_in_cart.quantity,
+                    price=product_in_cart.product.price,
+                )
+                for product_in_cart in product_lines
+            )
+            ProductDailySales.objects.add(
+                {(order.day, line.product_id): line.quantity for line in lines}
+            )
+            self.status = Cart.SUBMITTED
+            self.save()
+        logger.info("Created order with id=%d and lines_count=%d", order.id, len(lines))
         return order
 
     def __str__(self):
@@ -196,6 +576,9 @@ class ProductInCart(TimeStampedModel):
     product = models.ForeignKey(to=Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
 
+    class Meta:
+        unique_together = (("cart", "product"),)
+
 
 class Order(TimeStampedModel):
     """Order Model"""
@@ -223,13 +606,108 @@ class Order(TimeStampedModel):
     last_spoken_to = models.ForeignKey(
         User, null=True, related_name="cs_chats", on_delete=models.SET_NULL
     )
+    cart = models.ForeignKey(
+        Cart, null=True, blank=True, related_name="orders", on_delete=models.SET_NULL
+    )
+    # sent along with the checkout form, a retried submission finds the
+    # order it already created
+    idempotency_key = models.CharField(max_length=64, blank=True)
+
+    objects = OrderManager()
 
     def __str__(self):
         return f"{self.user.first_name}'s Order"
 
+    @property
+    def day(self):
+        """The local date the order was placed on, what reports group by"""
+        if timezone.is_aware(self.date_created):
+            return timezone.localdate(self.date_created)
+        return self.date_created.date()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["cart"], name="order_unique_cart"),
+            models.UniqueConstraint(
+                fields=["user", "idempotency_key"],
+                condition=~models.Q(idempotency_key=""),
+                name="order_unique_idempotency_key",
+            ),
+        ]
+        # the analytics read paid orders by date, and each customer's first
+        indexes = [
+            models.Index(
+                fields=["status", "date_created"], name="order_status_created"
+            ),
+            models.Index(
+                fields=["user", "status", "date_created"],
+                name="order_user_status_created",
+            ),
+        ]
+
+
+class OrderDailyRollup(models.Model):
+    """Order Daily Rollup Model
+
+    Notes
+    -----
+    How many orders were placed on a day, per current status and
+    shipping country. Kept up to date as orders change (see
+    ``OrderDailyRollupManager``), so reports read a few rows per day
+    instead of the orders table; ``rebuild_order_rollups`` recomputes
+    any range of days.
+    """
+
+    day = models.DateField()
+    status = models.IntegerField(choices=Order.STATUSES)
+    shipping_country = models.CharField(max_length=3)
+    count = models.IntegerField(default=0)
+
+    objects = OrderDailyRollupManager()
+
+    def __str__(self):
+        return f"{self.day} {self.get_status_display()} {self.shipping_country}"
+
+    class Meta:
+        unique_together = (("day", "status", "shipping_country"),)
+
+
+class ProductDailySales(models.Model):
+    """Product Daily Sales Model
+
+    Notes
+    -----
+    Units of a product ordered on a day. Bestseller rankings over any
+    window are sums of these rows (see ``ProductDailySalesManager``);
+    ``rebuild_order_rollups`` recomputes them from the order lines.
+    """
+
+    day = models.DateField()
+    product = models.ForeignKey(
+        to=Product, on_delete=models.CASCADE, related_name="daily_sales"
+    )
+    quantity = models.IntegerField(default=0)
+
+    objects = ProductDailySalesManager()
+
+    def __str__(self):
+        return f"{self.day} {self.product_id} x{self.quantity}"
+
+    class Meta:
+        unique_together = (("day", "product"),)
+        verbose_name_plural = _("Product daily sales")
+
 
 class OrderLine(TimeStampedModel):
-    """Order Line Model"""
+    """Order Line Model
+
+    Notes
+    -----
+    A line holds ``quantity`` units of a product, at the unit ``price``
+    the product had when the order was placed. Units can be shipped in
+    several goes: ``quantity_sent`` counts the units already sent, and
+    the line stays ``PROCESSING`` until all of them are.
+    """
 
     NEW = 10
     PROCESSING = 20
@@ -245,3 +723,39 @@ class OrderLine(TimeStampedModel):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="lines")
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
     status = models.IntegerField(choices=STATUSES, default=NEW)
+    quantity = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
+    quantity_sent = models.PositiveIntegerField(default=0)
+    price = models.DecimalField(max_digits=6, decimal_places=2)
+
+    objects = OrderLineQuerySet.as_manager()
+
+    @property
+    def quantity_pending(self):
+        return self.quantity - self.quantity_sent
+
+    def clean(self):
+        if self.quantity_sent > self.quantity:
+            raise ValidationError(
+                {"quantity_sent": _("Cannot send more units than ordered.")}
+            )
+
+    def send(self, quantity=None):
+        """Record units as shipped (all the pending ones by default)"""
+        if quantity is None:
+            quantity = self.quantity_pending
+        self.quantity_sent = min(self.quantity, self.quantity_sent + quantity)
+        self.status = (
+            OrderLine.SENT
+            if self.quantity_sent == self.quantity
+            else OrderLine.PROCESSING
+        )
+        self.save()
+
+    def save(self, *args, **kwargs):
+        # lines marked as sent in one go (admin, dispatch API) ship
+        # everything that was left
+        if self.status == OrderLine.SENT:
+            self.quantity_sent = self.quantity
+        if self.price is None:
+            self.price = self.product.price
+        super().save(*args, **kwargs)
@@ -0,0 +1,141 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+
+
+class KeysetPage:
+    """Keyset Page
+
+    Notes
+    -----
+    Mirrors the parts of django's ``Page`` API used by the templates,
+    without page numbers: a keyset page only knows its neighbours.
+    """
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        if not self._has_next:
+            return None
+        return self.paginator.encode_cursor("n", self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if not self._has_previous:
+            return None
+        return self.paginator.encode_cursor("p", self.object_list[0])
+
+
+class KeysetPaginator:
+    """Keyset (cursor) Paginator
+
+    Notes
+    -----
+    Pages through a queryset by filtering on the last seen values of
+    ``ordering`` instead of using OFFSET, so there is no COUNT(*) and
+    deep pages cost the same as the first one. The ordering must be
+    ascending, unique (end it with the primary key) and made of JSON
+    serializable values.
+
+    Cursors are opaque url-safe tokens carrying a direction (``n`` for
+    next, ``p`` for previous) and the key of the boundary row.
+    """
+
+    def __init__(self, queryset, per_page, ordering=("name", "id")):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+
+    def get_key(self, obj):
+        return [getattr(obj, field) for field in self.ordering]
+
+    def encode_cursor(self, direction, obj):
+        data = json.dumps([direction, self.get_key(obj)], separators=(",", ":"))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+    def decode_cursor(self, cursor):
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            direction, key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        except (binascii.Error, TypeError, ValueError, UnicodeDecodeError):
+            raise InvalidPage("Invalid cursor")
+        if (
+            direction not in ("n", "p")
+            or not isinstance(key, list)
+            or len(key) != len(self.ordering)
+        ):
+            raise InvalidPage("Invalid cursor")
+        return direction, self.clean_key(key)
+
+    def clean_key(self, key):
+        """Convert the key values to their fields, or raise InvalidPage"""
+        cleaned = []
+        for name, value in zip(self.ordering, key):
+            field = self.queryset.model._meta.get_field(name)
+            try:
+                value = field.to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                raise InvalidPage("Invalid cursor")
+            if value is None:
+                raise InvalidPage("Invalid cursor")
+            cleaned.append(value)
+        return cleaned
+
+    def _seek(self, key, lookup):
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y)
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            clause = {f: v for f, v in zip(self.ordering[:i], key[:i])}
+            clause["%s__%s" % (field, lookup)] = key[i]
+            condition |= Q(**clause)
+        return condition
+
+    def page(self, cursor=None):
+        size = self.per_page
+        if not cursor:
+            rows = list(self.queryset.order_by(*self.ordering)[: size + 1])
+            return KeysetPage(rows[:size], self, len(rows) > size, False)
+
+        direction, key = self.decode_cursor(cursor)
+        if direction == "n":
+            rows = list(
+                self.queryset.filter(self._seek(key, "gt")).order_by(*self.ordering)[
+                    : size + 1
+                ]
+            )
+            return KeysetPage(rows[:size], self, len(rows) > size, True)
+
+        reverse_ordering = ["-%s" % field for field in self.ordering]
+        rows = list(
+            self.queryset.filter(self._seek(key, "lt")).order_by(*reverse_ordering)[
+                : size + 1
+            ]
+        )
+        has_previous = len(rows) > size
+        rows = rows[:size]
+        rows.reverse()
+        return KeysetPage(rows, self, True, has_previous)
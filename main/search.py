@@ -0,0 +1,128 @@
+"""
+Product search backed by a local inverted index.
+
+Every active product is broken into terms (from its name, description
+and tag names) stored as ``SearchTerm`` rows. Queries are answered from
+that table only: each query token is matched as a prefix, products must
+match every token and are ranked by the summed weight of the matching
+terms.
+"""
+import logging
+import re
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, IntegerField, Max, Q, Sum, Value, When
+
+from .models import Product, SearchTerm
+
+logger = logging.getLogger(__name__)
+
+NAME_WEIGHT = 10
+TAG_WEIGHT = 5
+DESCRIPTION_WEIGHT = 1
+
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = SearchTerm._meta.get_field("term").max_length
+MAX_QUERY_TOKENS = 8
+
+STOP_WORDS = frozenset(
+    "an and are as at be by for from in is it of on or that the to with".split()
+)
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return [
+        token[:MAX_TERM_LENGTH]
+        for token in TOKEN_RE.findall((text or "").lower())
+        if len(token) >= MIN_TERM_LENGTH and token not in STOP_WORDS
+    ]
+
+
+def product_terms(product):
+    terms = Counter()
+    for token in tokenize(product.name):
+        terms[token] += NAME_WEIGHT
+    for name in product.tags.values_list("name", flat=True):
+        for token in tokenize(name):
+            terms[token] += TAG_WEIGHT
+    for token in tokenize(product.description):
+        terms[token] += DESCRIPTION_WEIGHT
+    return terms
+
+
+def index_product(product):
+    """Bring the index rows of one product in line with its current data.
+
+    Only the difference with what is already indexed is written, so
+    saving a product without touching its text costs a single read.
+    """
+    terms = product_terms(product) if product.active else {}
+    with transaction.atomic():
+        existing = dict(
+            SearchTerm.objects.filter(product=product).values_list("term", "weight")
+        )
+        stale = [term for term in existing if term not in terms]
+        if stale:
+            SearchTerm.objects.filter(product=product, term__in=stale).delete()
+        for term, weight in terms.items():
+            if term in existing and existing[term] != weight:
+                SearchTerm.objects.filter(product=product, term=term).update(
+                    weight=weight
+                )
+        SearchTerm.objects.bulk_create(
+            SearchTerm(product=product, term=term, weight=weight)
+            for term, weight in terms.items()
+            if term not in existing
+        )
+
+
+def index_products(products):
+    c = 0
+    for product in products.iterator():
+        index_product(product)
+        c += 1
+    logger.info("Indexed %d products for search", c)
+    return c
+
+
+def search(query, limit=20):
+    """Return up to ``limit`` active products matching ``query``, best first.
+
+    Each returned product carries its rank in ``search_score``.
+    """
+    tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TOKENS]
+    if not tokens:
+        return []
+
+    condition = Q()
+    matched = {}
+    for i, token in enumerate(tokens):
+        condition |= Q(term__startswith=token)
+        matched["token_%d" % i] = Max(
+            Case(
+                When(term__startswith=token, then=Value(1)),
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        )
+    rows = (
+        SearchTerm.objects.filter(condition, product__active=True)
+        .values("product")
+        .annotate(score=Sum("weight"), **matched)
+        .filter(**{name: 1 for name in matched})
+        .order_by("-score", "product")[:limit]
+    )
+    scores = {row["product"]: row["score"] for row in rows}
+    products = Product.objects.in_bulk(list(scores))
+    results = []
+    for product_id, score in scores.items():
+        # deleted since the terms were read
+        if product_id not in products:
+            continue
+        product = products[product_id]
+        product.search_score = score
+        results.append(product)
+    return results
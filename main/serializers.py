@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from main.models import OrderLine, Order
+from main.models import OrderLine, Order, Product
 
 
 class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
@@ -8,8 +8,26 @@ class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = OrderLine
-        fields = ("id", "order", "product", "status")
-        read_only_fields = ("id", "order", "product")
+        fields = (
+            "id",
+            "order",
+            "product",
+            "status",
+            "quantity",
+            "quantity_sent",
+            "price",
+        )
+        read_only_fields = ("id", "order", "product", "quantity", "price")
+
+    def validate_quantity_sent(self, value):
+        if self.instance is not None and value > self.instance.quantity:
+            raise serializers.ValidationError("Cannot send more units than ordered.")
+        return value
+
+
+class OrderLineTransitionSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), max_length=1000)
+    status = serializers.ChoiceField(choices=OrderLine.STATUSES)
 
 
 class OrderSerializer(serializers.HyperlinkedModelSerializer):
@@ -23,5 +41,13 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
             "shipping_city",
             "shipping_country",
             "date_updated",
-            "date_added",
+            "date_created",
         )
+
+
+class ProductSerializer(serializers.ModelSerializer):
+    score = serializers.IntegerField(source="search_score", read_only=True)
+
+    class Meta:
+        model = Product
+        fields = ("id", "name", "slug", "price", "in_stock", "score")
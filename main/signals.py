@@ -1,53 +1,275 @@
 import logging
-from io import BytesIO
+from collections import Counter
 
-from PIL import Image
 from django.contrib.auth import user_logged_in
-from django.core.files.base import ContentFile
-from django.db.models.signals import pre_save, post_save
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
 from django.dispatch import receiver
+from django.utils import timezone
 
-from .models import ProductImage, Cart, OrderLine, Order
-
-THUMBNAIL_SIZE = (300, 300)
+from . import caching, carts, facets, jobs, search, stock
+from .models import (
+    Product,
+    ProductTag,
+    ProductImage,
+    FacetBitmap,
+    Cart,
+    ProductInCart,
+    OrderLine,
+    Order,
+    OrderDailyRollup,
+    ProductDailySales,
+)
 
 logger = logging.getLogger(__name__)
 
 
 @receiver(pre_save, sender=ProductImage)
-def generate_thumbnail(sender, instance, **kwargs):
-    logger.info(
-        "Generating thumbnail for product %d",
-        instance.product.id,
+def mark_image_pending(sender, instance, raw=False, **kwargs):
+    if not raw and instance.has_changed("image"):
+        instance.status = ProductImage.PENDING
+
+
+# Decoding and resizing happen in the run_jobs worker, never on the
+# request or import that saved the image
+@receiver(post_save, sender=ProductImage)
+def queue_image_processing(sender, instance, created, raw=False, **kwargs):
+    if raw or not (created or instance.has_changed("image")):
+        return
+    jobs.enqueue("process_product_image", image_id=instance.id)
+
+
+@receiver(post_save, sender=Product)
+def index_product_for_search(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    search.index_product(instance)
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def index_product_tags_for_search(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        # the tag side is cleared without pk_set, remember who is affected
+        instance._search_product_ids = list(
+            instance.product_set.values_list("id", flat=True)
+        )
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        search.index_product(instance)
+        return
+    if action == "post_clear":
+        pk_set = getattr(instance, "_search_product_ids", [])
+    search.index_products(Product.objects.filter(pk__in=pk_set))
+
+
+@receiver(post_save, sender=ProductTag)
+def index_tag_products_for_search(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    search.index_products(instance.product_set.all())
+
+
+@receiver(pre_delete, sender=ProductTag)
+def remember_tag_products_for_search(sender, instance, **kwargs):
+    instance._search_product_ids = list(
+        instance.product_set.values_list("id", flat=True)
+    )
+
+
+@receiver(post_delete, sender=ProductTag)
+def reindex_tag_products_for_search(sender, instance, **kwargs):
+    search.index_products(
+        Product.objects.filter(pk__in=getattr(instance, "_search_product_ids", []))
+    )
+
+
+@receiver(post_save, sender=Product)
+def update_product_facets(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    facets.update_product(instance)
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def update_tag_facets(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear":
+        # clears come without pk_set, remember what is about to go
+        related = instance.product_set if reverse else instance.tags
+        instance._facet_cleared_ids = list(related.values_list("id", flat=True))
+        return
+    if action == "post_clear":
+        pk_set = getattr(instance, "_facet_cleared_ids", [])
+    elif action not in ("post_add", "post_remove"):
+        return
+    change = "add" if action == "post_add" else "remove"
+    if reverse:
+        facets.update_tag(instance.id, **{change: pk_set})
+    else:
+        facets.update_product_tags(instance.id, pk_set, action == "post_add")
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_tags_for_facets(sender, instance, **kwargs):
+    instance._facet_tag_ids = list(instance.tags.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_facets(sender, instance, **kwargs):
+    facets.remove_product(instance.id, getattr(instance, "_facet_tag_ids", []))
+
+
+@receiver(post_delete, sender=ProductTag)
+def remove_tag_facet(sender, instance, **kwargs):
+    FacetBitmap.objects.filter(facet=FacetBitmap.TAG, value=str(instance.id)).delete()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductTag)
+@receiver(post_delete, sender=ProductTag)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(m2m_changed, sender=Product.tags.through)
+def invalidate_catalog_cache(sender, **kwargs):
+    if kwargs.get("action", "post_").startswith("post_"):
+        caching.bump_catalog_version()
+
+
+# Checkouts and cancellations move stock with UPDATEs, no post_save
+@receiver(stock.stock_changed)
+def update_stock_facets(sender, product_ids, **kwargs):
+    in_stock = dict(
+        Product.objects.filter(pk__in=product_ids).values_list("id", "in_stock")
+    )
+    facets.update_stock(
+        add=[product_id for product_id, flag in in_stock.items() if flag],
+        remove=[product_id for product_id, flag in in_stock.items() if not flag],
+    )
+    caching.bump_catalog_version()
+
+
+def touch_products(product_ids):
+    Product.objects.filter(pk__in=product_ids).update(date_updated=timezone.now())
+
+
+# Tags and images are part of the product page, keep date_updated (and
+# so the page ETag / Last-Modified) moving when they change
+@receiver(m2m_changed, sender=Product.tags.through)
+def touch_products_on_tags_change(sender, instance, action, reverse, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        touch_products([instance.id])
+    elif action == "post_clear":
+        touch_products(getattr(instance, "_facet_cleared_ids", []))
+    else:
+        touch_products(kwargs["pk_set"])
+
+
+@receiver(post_save, sender=ProductTag)
+def touch_products_on_tag_save(sender, instance, created, raw=False, **kwargs):
+    if not (raw or created):
+        instance.product_set.update(date_updated=timezone.now())
+
+
+@receiver(post_delete, sender=ProductImage)
+def touch_product_on_image_delete(sender, instance, **kwargs):
+    touch_products([instance.product_id])
+
+
+def add_to_cart_summary(cart_id, quantity, price):
+    if quantity:
+        Cart.objects.add_to_summary(cart_id, quantity, quantity * price)
+        caching.invalidate_cart(cart_id)
+
+
+@receiver(post_save, sender=ProductInCart)
+def update_cart_summary(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    price = instance.product.price
+    old_cart_id = instance.loaded_value("cart")
+    old_product_id = instance.loaded_value("product")
+    if created:
+        add_to_cart_summary(instance.cart_id, instance.quantity, price)
+    elif old_cart_id is None:
+        # saved without being loaded first, nothing to diff against
+        Cart.objects.recompute_summary(
+            Cart.objects.filter(pk=instance.cart_id), date_updated=timezone.now()
+        )
+        caching.invalidate_cart(instance.cart_id)
+    elif (old_cart_id, old_product_id) == (instance.cart_id, instance.product_id):
+        quantity = instance.quantity - instance.loaded_value("quantity")
+        add_to_cart_summary(instance.cart_id, quantity, price)
+    else:
+        old_price = price
+        if old_product_id != instance.product_id:
+            old_price = (
+                Product.objects.filter(pk=old_product_id)
+                .values_list("price", flat=True)
+                .first()
+            ) or 0
+        add_to_cart_summary(old_cart_id, -instance.loaded_value("quantity"), old_price)
+        add_to_cart_summary(instance.cart_id, instance.quantity, price)
+
+
+@receiver(post_delete, sender=ProductInCart)
+def remove_from_cart_summary(sender, instance, **kwargs):
+    add_to_cart_summary(
+        instance.cart_id,
+        -instance.loaded_value("quantity", instance.quantity),
+        instance.product.price,
     )
-    image = Image.open(instance.image)
-    image = image.convert("RGB")
-    image.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
-    temp_thumb = BytesIO()
-    image.save(temp_thumb, "JPEG")
-    temp_thumb.seek(0)
-    # set save=False, otherwise it will run in an infinite loop
-    instance.thumbnail.save(
-        instance.image.name,
-        ContentFile(temp_thumb.read()),
-        save=False,
+
+
+@receiver(post_save, sender=Product)
+def update_cart_totals_on_price_change(sender, instance, created, raw=False, **kwargs):
+    if raw or created or not instance.has_changed("price"):
+        return
+    cart_ids = list(
+        Cart.objects.filter(
+            status=Cart.OPEN, productincart__product=instance
+        ).values_list("id", flat=True)
     )
-    temp_thumb.close()
+    Cart.objects.recompute_summary(Cart.objects.filter(pk__in=cart_ids))
+    for cart_id in cart_ids:
+        caching.invalidate_cart(cart_id)
+
+
+@receiver(post_save, sender=Cart)
+@receiver(post_delete, sender=Cart)
+def invalidate_cached_cart(sender, instance, raw=False, **kwargs):
+    if not raw:
+        caching.invalidate_cart(instance.id)
 
 
 @receiver(user_logged_in)
 def merge_baskets_if_found(sender, user, request, **kwargs):
     anonymous_cart = getattr(request, "cart", None)
-    if anonymous_cart:
-        try:
-            loggedin_cart = Cart.objects.get(user=user, status=Cart.OPEN)
-            for product_in_cart in anonymous_cart.productincart_set.all():
-                product_in_cart.cart = loggedin_cart
-                product_in_cart.save()
-            anonymous_cart.delete()
+    if isinstance(anonymous_cart, carts.SessionCart):
+        request.cart = anonymous_cart.materialize(
+            user, Cart.objects.filter(user=user, status=Cart.OPEN).first()
+        )
+    elif anonymous_cart:
+        loggedin_cart = (
+            Cart.objects.filter(user=user, status=Cart.OPEN)
+            .exclude(pk=anonymous_cart.id)
+            .first()
+        )
+        if loggedin_cart:
+            loggedin_cart.merge(anonymous_cart)
             request.cart = loggedin_cart
+            request.session["cart_id"] = loggedin_cart.id
             logger.info("Merged cart to id %d", loggedin_cart.id)
-        except Cart.DoesNotExist:
+        elif anonymous_cart.user_id != user.id:
             anonymous_cart.user = user
             anonymous_cart.save()
             logger.info(
@@ -56,6 +278,101 @@ def merge_baskets_if_found(sender, user, request, **kwargs):
             )
 
 
+def order_rollup_key(order, status, shipping_country):
+    return (order.day, status, shipping_country)
+
+
+@receiver(post_save, sender=Order)
+def update_order_rollup(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    new = order_rollup_key(instance, instance.status, instance.shipping_country)
+    if created:
+        OrderDailyRollup.objects.add({new: 1})
+        return
+    if instance.loaded_value("status") is None:
+        # saved without being loaded first, nothing to diff against
+        day = new[0]
+        transaction.on_commit(lambda: OrderDailyRollup.objects.rebuild(day, day))
+        return
+    old = order_rollup_key(
+        instance,
+        instance.loaded_value("status"),
+        instance.loaded_value("shipping_country"),
+    )
+    if old != new:
+        OrderDailyRollup.objects.add({old: -1, new: 1})
+
+
+# Paid orders are the ones whose invoice gets downloaded, have it
+# rendered by the run_jobs worker before anyone asks
+@receiver(post_save, sender=Order)
+def queue_invoice_rendering(sender, instance, created, raw=False, **kwargs):
+    if raw or instance.status != Order.PAID:
+        return
+    if created or instance.loaded_value("status") != Order.PAID:
+        jobs.enqueue("render_invoice", order_id=instance.id)
+
+
+@receiver(post_delete, sender=Order)
+def remove_from_order_rollup(sender, instance, **kwargs):
+    key = order_rollup_key(
+        instance,
+        instance.loaded_value("status", instance.status),
+        instance.loaded_value("shipping_country", instance.shipping_country),
+    )
+    OrderDailyRollup.objects.add({key: -1})
+
+
+def sold_units(status, quantity, quantity_sent):
+    # a cancelled line only sold what was sent before it was cancelled
+    return quantity_sent if status == OrderLine.CANCELLED else quantity
+
+
+@receiver(post_save, sender=OrderLine)
+def update_product_sales(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    day = instance.order.day
+    changes = Counter()
+    changes[day, instance.product_id] += sold_units(
+        instance.status, instance.quantity, instance.quantity_sent
+    )
+    if not created:
+        old_product_id = instance.loaded_value("product")
+        if old_product_id is None:
+            # saved without being loaded first, nothing to diff against
+            transaction.on_commit(lambda: ProductDailySales.objects.rebuild(day, day))
+            return
+        changes[day, old_product_id] -= sold_units(
+            instance.loaded_value("status"),
+            instance.loaded_value("quantity"),
+            instance.loaded_value("quantity_sent"),
+        )
+    ProductDailySales.objects.add(changes)
+
+
+@receiver(post_delete, sender=OrderLine)
+def remove_product_sales(sender, instance, **kwargs):
+    order = Order.objects.filter(pk=instance.order_id).first()
+    if order is not None:
+        product_id = instance.loaded_value("product", instance.product_id)
+        units = sold_units(
+            instance.loaded_value("status", instance.status),
+            instance.loaded_value("quantity", instance.quantity),
+            instance.loaded_value("quantity_sent", instance.quantity_sent),
+        )
+        ProductDailySales.objects.add({(order.day, product_id): -units})
+
+
+@receiver(post_save, sender=OrderLine)
+def release_cancelled_stock(sender, instance, created, raw=False, **kwargs):
+    if raw or created or instance.status != OrderLine.CANCELLED:
+        return
+    if instance.loaded_value("status") != OrderLine.CANCELLED:
+        stock.release({instance.product_id: instance.quantity_pending})
+
+
 @receiver(post_save, sender=OrderLine)
 def orderline_to_order_status(sender, instance: OrderLine, **kwargs):
     if not instance.order.lines.filter(status__lt=OrderLine.SENT).exists():
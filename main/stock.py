@@ -0,0 +1,89 @@
+"""
+Stock counters.
+
+``Product.stock`` is left empty for products whose stock is not
+tracked (their ``in_stock`` flag is still set by hand). Tracked stock
+only moves through conditional UPDATEs: a checkout takes its units with
+``stock = stock - n WHERE stock >= n``, so concurrent checkouts of the
+same title never oversell and no row is locked before it is written.
+``in_stock`` follows the counter; ``stock_changed`` is sent for the
+products that sold out or came back, so facets and caches can follow.
+"""
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.db.models import BooleanField, Case, F, Value, When
+from django.dispatch import Signal
+from django.utils import timezone
+
+stock_changed = Signal(providing_args=["product_ids"])
+
+
+class OutOfStock(ValidationError):
+    def __init__(self, product):
+        super().__init__("Sorry, %s is out of stock." % product)
+        self.product = product
+
+
+def _products():
+    return apps.get_model("main", "Product").objects
+
+
+def reserve(quantities):
+    """Take ``{product id: units}`` out of stock, or raise OutOfStock.
+
+    Call it inside a transaction: a failure leaves the earlier
+    decrements to be rolled back. Products are decremented in id order,
+    so concurrent checkouts take their row locks in the same order.
+    """
+    now = timezone.now()
+    reserved = []
+    for product_id, quantity in sorted(quantities.items()):
+        updated = (
+            _products()
+            .filter(pk=product_id, stock__gte=quantity)
+            .update(
+                stock=F("stock") - quantity,
+                in_stock=Case(
+                    When(stock__gt=quantity, then=Value(True)),
+                    default=Value(False),
+                    output_field=BooleanField(),
+                ),
+                # only a sell out changes what the catalog shows
+                date_updated=Case(
+                    When(stock=quantity, then=Value(now)),
+                    default=F("date_updated"),
+                ),
+            )
+        )
+        if updated:
+            reserved.append(product_id)
+            continue
+        product = _products().filter(pk=product_id, stock__isnull=False).first()
+        if product is not None:
+            raise OutOfStock(product)
+    # the rows are still locked by this transaction, a stock of 0 is ours
+    sold_out = list(
+        _products().filter(pk__in=reserved, stock=0).values_list("id", flat=True)
+    )
+    if sold_out:
+        stock_changed.send(sender=reserve, product_ids=sold_out)
+    return reserved
+
+
+def release(quantities):
+    """Put ``{product id: units}`` back in stock (untracked ones are skipped)"""
+    now = timezone.now()
+    quantities = {
+        product_id: quantity for product_id, quantity in quantities.items() if quantity
+    }
+    back = list(
+        _products()
+        .filter(pk__in=list(quantities), stock=0)
+        .values_list("id", flat=True)
+    )
+    for product_id, quantity in sorted(quantities.items()):
+        _products().filter(pk=product_id, stock__isnull=False).update(
+            stock=F("stock") + quantity, in_stock=True, date_updated=now
+        )
+    if back:
+        stock_changed.send(sender=release, product_ids=back)
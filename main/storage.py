@@ -0,0 +1,59 @@
+"""
+File storage addressed by content.
+
+Files are named after the sha256 of their bytes, so saving the same
+bytes twice (an import run again, the same cover on two products)
+stores them once and gives back the same name, which in turn lets
+``main.imaging`` reuse what was already generated for that name.
+"""
+import hashlib
+import os
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+CHUNK_SIZE = 64 * 1024
+
+
+def content_hash(content):
+    """sha256 hex digest of a file-like object, read in chunks"""
+    digest = hashlib.sha256()
+    if hasattr(content, "seek"):
+        content.seek(0)
+    if hasattr(content, "chunks"):
+        chunks = content.chunks(CHUNK_SIZE)
+    else:
+        chunks = iter(lambda: content.read(CHUNK_SIZE), b"")
+    for chunk in chunks:
+        digest.update(chunk)
+    if hasattr(content, "seek"):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage saving files as ``<dir>/<ab>/<cd>/<sha256><ext>``
+
+    Notes
+    -----
+    A file that is already stored is not written again. Because names
+    are shared, files must only be deleted once nothing refers to them.
+    """
+
+    def hashed_name(self, name, content):
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        digest = content_hash(content)
+        return os.path.join(directory, digest[:2], digest[2:4], digest + extension)
+
+    def _save(self, name, content):
+        name = self.hashed_name(name, content)
+        if self.exists(name):
+            return name
+        # if another process stores the same bytes in the meantime, the
+        # parent class falls back to a suffixed name: a harmless copy
+        return super()._save(name, content)
+
+
+content_addressed_storage = ContentAddressedStorage()
@@ -0,0 +1,30 @@
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test import override_settings
+
+
+def use_temporary_media_root(test_case):
+    """Store the files of ``test_case`` in a directory removed after it"""
+    media_root = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+    media_settings = override_settings(MEDIA_ROOT=media_root)
+    media_settings.enable()
+    test_case.addCleanup(media_settings.disable)
+
+
+@contextmanager
+def run_on_commit():
+    """Run the ``on_commit`` callbacks registered in the block when it exits.
+
+    ``TestCase`` never commits, this stands in for the commit (like the
+    ``captureOnCommitCallbacks(execute=True)`` of later Django releases).
+    """
+    start = len(connection.run_on_commit)
+    yield
+    callbacks = connection.run_on_commit[start:]
+    del connection.run_on_commit[start:]
+    for _, callback in callbacks:
+        callback()
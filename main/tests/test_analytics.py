@@ -0,0 +1,112 @@
+from datetime import datetime
+from decimal import Decimal
+
+import pytz
+from django.test import TestCase
+
+from main import analytics, models
+from main.tests import factories
+
+
+class TestAnalytics(TestCase):
+    def order(self, user, when, lines, status=models.Order.PAID):
+        order = factories.OrderFactory(user=user, status=status)
+        for price, quantity in lines:
+            factories.OrderLineFactory(
+                order=order,
+                product=self.product,
+                price=Decimal(price),
+                quantity=quantity,
+            )
+        models.Order.objects.filter(pk=order.pk).update(date_created=when)
+        return order
+
+    def setUp(self):
+        self.product = factories.ProductFactory(price=Decimal("99.00"))
+        self.ann = factories.UserFactory(email="ann@site.com")
+        self.bob = factories.UserFactory(email="bob@site.com")
+        utc = pytz.utc
+        # 23:30 UTC on the 31st is already February in Kolkata
+        self.order(self.ann, utc.localize(datetime(2020, 1, 10, 9)), [("10", 2)])
+        self.order(self.bob, utc.localize(datetime(2020, 1, 31, 23, 30)), [("5", 1)])
+        self.order(
+            self.ann,
+            utc.localize(datetime(2020, 2, 3, 9)),
+            [("10", 1), ("2.50", 2)],
+        )
+        self.order(
+            self.bob,
+            utc.localize(datetime(2020, 2, 4, 9)),
+            [("100", 1)],
+            status=models.Order.NEW,
+        )
+        self.range = (
+            utc.localize(datetime(2020, 1, 1)),
+            utc.localize(datetime(2020, 3, 1)),
+        )
+
+    def test_sales_per_month_in_a_timezone(self):
+        report = analytics.sales(
+            *self.range, granularity="month", tz=pytz.timezone("Asia/Kolkata")
+        )
+
+        self.assertEqual(
+            report["periods"],
+            [
+                {
+                    "period": "2020-01",
+                    "orders": 1,
+                    "revenue": 20.0,
+                    "aov": 20.0,
+                    "units": 2,
+                    "repeat_rate": 0.0,
+                },
+                {
+                    "period": "2020-02",
+                    "orders": 2,
+                    "revenue": 20.0,
+                    "aov": 10.0,
+                    "units": 4,
+                    "repeat_rate": 0.5,
+                },
+            ],
+        )
+        self.assertEqual(report["totals"]["customers"], 2)
+        self.assertEqual(report["totals"]["revenue"], 40.0)
+
+    def test_cohorts(self):
+        report = analytics.cohorts(*self.range, granularity="month", tz=pytz.utc)
+
+        self.assertEqual(report["periods"], ["2020-01", "2020-02"])
+        self.assertEqual(
+            report["cohorts"],
+            [{"cohort": "2020-01", "customers": 2, "retention": [1.0, 0.5]}],
+        )
+
+    def test_cancelled_lines_are_not_revenue(self):
+        order = models.Order.objects.get(
+            user=self.ann, date_created__month=2, status=models.Order.PAID
+        )
+        factories.OrderLineFactory(
+            order=order,
+            product=self.product,
+            price=Decimal("50"),
+            quantity=1,
+            status=models.OrderLine.CANCELLED,
+        )
+        report = analytics.sales(*self.range, granularity="month", tz=pytz.utc)
+
+        self.assertEqual(report["totals"]["revenue"], 40.0)
+        self.assertEqual(report["totals"]["units"], 6)
+
+    def test_cohorts_from_mid_period_start_are_whole(self):
+        start = pytz.utc.localize(datetime(2020, 1, 20))
+        report = analytics.cohorts(
+            start, self.range[1], granularity="month", tz=pytz.utc
+        )
+
+        # ann's first order is on the 10th, still January's cohort
+        self.assertEqual(
+            report["cohorts"],
+            [{"cohort": "2020-01", "customers": 2, "retention": [1.0, 0.5]}],
+        )
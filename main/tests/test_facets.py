@@ -0,0 +1,90 @@
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from main import facets, models
+
+
+class TestFacets(TestCase):
+    def setUp(self):
+        self.fiction = models.ProductTag.objects.create(name="Fiction", slug="fiction")
+        self.kids = models.ProductTag.objects.create(name="Kids", slug="kids")
+        self.cheap = models.Product.objects.create(
+            name="Cheap", slug="cheap", price=Decimal("5.00")
+        )
+        self.dear = models.Product.objects.create(
+            name="Dear", slug="dear", price=Decimal("150.00"), in_stock=False
+        )
+        self.cheap.tags.add(self.fiction, self.kids)
+        self.fiction.product_set.add(self.dear)
+
+    def counts(self, **kwargs):
+        result = facets.facet_counts(**kwargs)
+        return (
+            {t["tag"].slug: t["count"] for t in result["tags"]},
+            {p["key"]: p["count"] for p in result["prices"] if p["count"]},
+            result["in_stock"]["count"],
+        )
+
+    def test_counts_follow_selected_filters(self):
+        self.assertEqual(
+            self.counts(), ({"fiction": 2, "kids": 1}, {"0-10": 1, "100+": 1}, 1)
+        )
+        self.assertEqual(
+            self.counts(tag_ids=[self.kids.id]),
+            ({"fiction": 1, "kids": 1}, {"0-10": 1}, 1),
+        )
+        self.assertEqual(
+            self.counts(price="100+"), ({"fiction": 1}, {"0-10": 1, "100+": 1}, 0)
+        )
+
+    def test_bitmaps_are_maintained_incrementally(self):
+        self.dear.price = Decimal("20.00")
+        self.dear.in_stock = True
+        self.dear.save()
+        self.cheap.tags.clear()
+        self.assertEqual(self.counts(), ({"fiction": 1}, {"0-10": 1, "10-25": 1}, 2))
+
+        self.cheap.active = False
+        self.cheap.save()
+        self.dear.delete()
+        self.assertEqual(self.counts(), ({}, {}, 0))
+
+        facets.rebuild()
+        self.assertEqual(self.counts(), ({}, {}, 0))
+
+    def test_saves_only_touch_the_bitmaps_that_changed(self):
+        self.cheap.description = "Still cheap"
+        with CaptureQueriesContext(connection) as context:
+            self.cheap.save()
+        self.assertFalse(
+            [q for q in context.captured_queries if "facetbitmap" in q["sql"]]
+        )
+
+        self.assertEqual(facets.price_bucket(Decimal("-1.00")), "0-10")
+
+    def test_tag_bitmaps_are_locked_in_one_order(self):
+        nine = models.ProductTag.objects.create(id=9, name="Nine", slug="nine")
+        ten = models.ProductTag.objects.create(id=10, name="Ten", slug="ten")
+        product = models.Product.objects.create(
+            name="Atlas", slug="atlas", price=Decimal("10.00")
+        )
+
+        orders = []
+        for change in (
+            lambda: product.tags.add(nine, ten),
+            lambda: facets.remove_product(product.id, [nine.id, ten.id]),
+        ):
+            with patch("main.facets._update_bits") as update_bits:
+                change()
+            orders.append(
+                [
+                    call.args[1]
+                    for call in update_bits.call_args_list
+                    if call.args[0] == models.FacetBitmap.TAG
+                ]
+            )
+        self.assertEqual(orders[0], orders[1])
@@ -0,0 +1,82 @@
+from decimal import Decimal
+from io import BytesIO
+
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+
+from main import imaging, jobs, models
+from main.tests import use_temporary_media_root
+
+
+def jpeg_bytes(size):
+    output = BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(output, "JPEG")
+    return output.getvalue()
+
+
+class TestImaging(TestCase):
+    def setUp(self):
+        use_temporary_media_root(self)
+        self.product = models.Product.objects.create(
+            name="Atlas", slug="atlas", price=Decimal("30.00")
+        )
+
+    def test_large_jpegs_are_decoded_at_a_reduced_scale(self):
+        image = models.ProductImage.objects.create(
+            product=self.product,
+            image=ContentFile(jpeg_bytes((6000, 4000)), name="atlas.jpg"),
+        )
+        with self.assertLogs("main.imaging", level="INFO"):
+            stats = imaging.process(image)
+
+        self.assertEqual(stats.source_size, (6000, 4000))
+        self.assertLess(stats.decoded_size[0], 6000 // 2)
+        self.assertGreaterEqual(stats.decoded_size[0], 1024)
+        self.assertLess(stats.peak_bytes, 6000 * 4000 * 4 // 4)
+        self.assertIsNotNone(stats.seconds)
+        self.assertEqual(
+            sorted(set(image.derivatives.values_list("width", "height"))),
+            [(160, 107), (320, 213), (640, 427), (1024, 683)],
+        )
+
+    def test_buffer_bytes_count_what_pillow_allocates(self):
+        self.assertEqual(imaging.buffer_bytes(Image.new("RGB", (10, 10))), 400)
+        self.assertEqual(imaging.buffer_bytes(Image.new("RGBA", (10, 10))), 400)
+        self.assertEqual(imaging.buffer_bytes(Image.new("L", (10, 10))), 100)
+
+    @override_settings(PRODUCT_IMAGE_MEMORY_BUDGET=1000)
+    def test_images_over_budget_fail_without_retries(self):
+        image = models.ProductImage.objects.create(
+            product=self.product,
+            image=ContentFile(jpeg_bytes((400, 300)), name="atlas.jpg"),
+        )
+        with self.assertLogs("main.jobs", level="ERROR"):
+            jobs.run_pending()
+
+        job = models.Job.objects.get(kind="process_product_image")
+        self.assertEqual(job.status, models.Job.FAILED)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("ImageTooLarge", job.last_error)
+        image.refresh_from_db()
+        self.assertEqual(image.status, models.ProductImage.FAILED)
+
+    def test_same_bytes_reuse_files_and_derivatives(self):
+        data = jpeg_bytes((800, 600))
+        first = models.ProductImage.objects.create(
+            product=self.product, image=ContentFile(data, name="atlas.jpg")
+        )
+        jobs.run_pending()
+        second = models.ProductImage.objects.create(
+            product=self.product, image=ContentFile(data, name="atlas-copy.jpg")
+        )
+        with self.assertLogs("main.imaging", level="INFO") as cm:
+            jobs.run_pending()
+
+        self.assertIn("Reused the thumbnail and derivatives", cm.output[0])
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(second.status, models.ProductImage.READY)
+        self.assertEqual(second.image.name, first.image.name)
+        self.assertEqual(second.thumbnail.name, first.thumbnail.name)
+        self.assertEqual(second.jpeg_srcset, first.jpeg_srcset)
@@ -0,0 +1,78 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from main import jobs, models
+
+calls = []
+
+
+def flaky(fail_times):
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise OSError("temporary failure")
+
+
+failures = []
+
+jobs.handler("test_flaky", on_failure=lambda **payload: failures.append(payload))(flaky)
+
+
+@override_settings(JOBS_MAX_ATTEMPTS=2, JOBS_RETRY_DELAY=60)
+class TestJobs(TestCase):
+    def setUp(self):
+        calls.clear()
+        failures.clear()
+
+    def test_failed_job_is_retried_later(self):
+        job = jobs.enqueue("test_flaky", fail_times=1)
+        with self.assertLogs("main.jobs", level="WARNING"):
+            self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.Job.QUEUED)
+        self.assertIn("temporary failure", job.last_error)
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=50))
+        # not due yet
+        self.assertEqual(jobs.run_pending(), 0)
+
+        later = timezone.now() + timedelta(minutes=2)
+        with patch("django.utils.timezone.now", return_value=later):
+            self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.Job.DONE)
+        self.assertEqual(job.attempts, 2)
+
+    def test_job_fails_after_max_attempts(self):
+        job = jobs.enqueue("test_flaky", fail_times=5)
+        models.Job.objects.filter(pk=job.pk).update(attempts=1)
+        with self.assertLogs("main.jobs", level="ERROR"):
+            jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.Job.FAILED)
+        self.assertEqual(failures, [{"fail_times": 5}])
+
+    def test_stale_running_jobs_are_requeued(self):
+        job = jobs.enqueue("test_flaky", fail_times=0)
+        self.assertEqual(jobs.claim("dead-worker"), [job])
+        models.Job.objects.filter(pk=job.pk).update(
+            locked_at=timezone.now() - timedelta(hours=1)
+        )
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(jobs.run_pending(), 1)
+
+    def test_stale_jobs_out_of_attempts_fail(self):
+        job = jobs.enqueue("test_flaky", fail_times=5)
+        models.Job.objects.filter(pk=job.pk).update(attempts=1)
+        self.assertEqual(jobs.claim("dead-worker"), [job])
+        models.Job.objects.filter(pk=job.pk).update(
+            locked_at=timezone.now() - timedelta(hours=1)
+        )
+        with self.assertLogs("main.jobs", level="ERROR"):
+            self.assertEqual(jobs.requeue_stale(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.Job.FAILED)
+        self.assertEqual(job.locked_by, "")
+        self.assertEqual(failures, [{"fail_times": 5}])
+        self.assertEqual(jobs.run_pending(), 0)
@@ -1,9 +1,14 @@
+from datetime import timedelta
+from decimal import Decimal
 from io import StringIO
+import os
 import tempfile
 from django.conf import settings
 from django.core.management import call_command
 from django.test import TestCase, override_settings
+from django.utils import timezone
 from main import models
+from main.tests import use_temporary_media_root
 
 
 class TestImportDataCommand(TestCase):
@@ -16,9 +21,102 @@ class TestImportDataCommand(TestCase):
             "Importing Products\n"
             "Products processed=3 (created=3)\n"
             "Tags processed=6 (created=6)\n"
-            "Images processed=3\n"
+            "Images processed=3 (duplicates=0)\n"
         )
         self.assertEqual(out.getvalue(), expected_out)
         self.assertEqual(models.Product.objects.count(), 3)
         self.assertEqual(models.ProductTag.objects.count(), 6)
         self.assertEqual(models.ProductImage.objects.count(), 3)
+
+    def test_import_data_twice_stores_images_once(self):
+        use_temporary_media_root(self)
+        args = ["main/fixtures/product-sample.csv", "main/fixtures/sample-images/"]
+        call_command("import_data", *args, stdout=StringIO())
+        out = StringIO()
+        call_command("import_data", *args, stdout=out)
+
+        self.assertIn("Images processed=3 (duplicates=3)", out.getvalue())
+        self.assertEqual(models.ProductImage.objects.count(), 3)
+        names = set(models.ProductImage.objects.values_list("image", flat=True))
+        stored = os.walk(os.path.join(settings.MEDIA_ROOT, "product-images"))
+        self.assertEqual(sum(len(files) for _, _, files in stored), len(names))
+
+
+class TestPurgeCartsCommand(TestCase):
+    def test_purge_carts_deletes_abandoned_carts_in_batches(self):
+        user = models.User.objects.create_user("user1@a.com", "pw432joij")
+        product = models.Product.objects.create(
+            name="Atlas", slug="atlas", price=Decimal("10.00")
+        )
+        old = timezone.now() - timedelta(days=30)
+        for owner in (None, None, None, user):
+            cart = models.Cart.objects.create(user=owner)
+            models.ProductInCart.objects.create(cart=cart, product=product)
+        models.Cart.objects.update(date_updated=old)
+        models.ProductInCart.objects.update(date_updated=old)
+        recent = models.Cart.objects.create()
+
+        out = StringIO()
+        call_command("purge_carts", "--dry-run", stdout=out)
+        self.assertEqual(out.getvalue(), "Would delete carts=3, lines=3\n")
+        self.assertEqual(models.Cart.objects.count(), 5)
+
+        out = StringIO()
+        call_command("purge_carts", "--batch-size=2", stdout=out)
+        self.assertIn("Carts deleted=3, lines=3", out.getvalue())
+        self.assertEqual(
+            sorted(models.Cart.objects.values_list("id", flat=True)),
+            sorted([recent.id, models.Cart.objects.get(user=user).id]),
+        )
+        self.assertEqual(models.ProductInCart.objects.count(), 1)
+
+    def test_purge_carts_keeps_edited_and_submitted_carts(self):
+        user = models.User.objects.create_user("user1@a.com", "pw432joij")
+        product = models.Product.objects.create(
+            name="Atlas", slug="atlas", price=Decimal("10.00")
+        )
+        old = timezone.now() - timedelta(days=200)
+        edited = models.Cart.objects.create()
+        models.ProductInCart.objects.create(cart=edited, product=product)
+        submitted = models.Cart.objects.create(user=user, status=models.Cart.SUBMITTED)
+        stale = models.Cart.objects.create(user=user)
+        for _ in range(3):
+            models.ProductInCart.objects.create(
+                cart=stale,
+                product=models.Product.objects.create(
+                    name="Atlas", slug="atlas", price=Decimal("10.00")
+                ),
+            )
+        models.Cart.objects.update(date_updated=old)
+        line = models.ProductInCart.objects.get(cart=edited)
+        line.quantity = 2
+        line.save()
+
+        # a fixed count per batch: one DELETE for the lines, however many
+        with self.assertNumQueries(11):
+            call_command("purge_carts", stdout=StringIO())
+        self.assertEqual(
+            sorted(models.Cart.objects.values_list("id", flat=True)),
+            sorted([edited.id, submitted.id]),
+        )
+        self.assertFalse(models.ProductInCart.objects.filter(cart=stale).exists())
+
+
+class TestCollapseOrderLinesCommand(TestCase):
+    def test_collapse_orderlines_keeps_quantities_per_status(self):
+        user = models.User.objects.create_user("user1@a.com", "pw432joij")
+        order = models.Order.objects.create(user=user)
+        product = models.Product.objects.create(
+            name="Atlas", slug="atlas", price=Decimal("10.00")
+        )
+        for status in (models.OrderLine.NEW,) * 3 + (models.OrderLine.SENT,) * 2:
+            models.OrderLine.objects.create(order=order, product=product, status=status)
+
+        out = StringIO()
+        call_command("collapse_orderlines", "--batch-size=1", stdout=out)
+
+        self.assertIn("Orders processed=1, lines removed=3", out.getvalue())
+        self.assertEqual(
+            sorted(order.lines.values_list("status", "quantity", "quantity_sent")),
+            [(models.OrderLine.NEW, 3, 0), (models.OrderLine.SENT, 2, 2)],
+        )
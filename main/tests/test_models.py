@@ -1,7 +1,19 @@
 from decimal import Decimal
+from io import StringIO
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
-from main import models
-from main.tests.factories import ProductFactory, UserFactory, AddressFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from main import facets, models, stock
+from main.tests import run_on_commit
+from main.tests.factories import (
+    ProductFactory,
+    UserFactory,
+    AddressFactory,
+    OrderFactory,
+    OrderLineFactory,
+)
 
 
 class TestProduct(TestCase):
@@ -38,3 +50,165 @@ class TestCart(TestCase):
         lines = order.lines.all()
         self.assertEqual(lines[0].product, p1)
         self.assertEqual(lines[1].product, p2)
+
+    def test_summary_follows_lines_and_prices(self):
+        p1 = ProductFactory(price=Decimal("10.00"))
+        p2 = ProductFactory(price=Decimal("4.50"))
+        cart = models.Cart.objects.create()
+        line = models.ProductInCart.objects.create(cart=cart, product=p1, quantity=2)
+        models.ProductInCart.objects.create(cart=cart, product=p2)
+        cart.refresh_from_db()
+        self.assertEqual((cart.item_count, cart.total), (3, Decimal("24.50")))
+
+        line = models.ProductInCart.objects.get(pk=line.pk)
+        line.quantity = 5
+        line.save()
+        p2.price = Decimal("5.00")
+        p2.save()
+        # a stale instance saved in full keeps the summary
+        cart.save()
+        cart.refresh_from_db()
+        self.assertEqual((cart.item_count, cart.total), (6, Decimal("55.00")))
+
+        line.delete()
+        with self.assertNumQueries(1):
+            cart = models.Cart.objects.get(pk=cart.pk)
+            self.assertEqual(cart.count(), 1)
+            self.assertFalse(cart.is_empty())
+        self.assertEqual(cart.total, Decimal("5.00"))
+
+    def test_merge_sums_overlapping_lines(self):
+        p1 = ProductFactory(price=Decimal("10.00"))
+        p2 = ProductFactory(price=Decimal("4.00"))
+        cart = models.Cart.objects.create()
+        other = models.Cart.objects.create()
+        models.ProductInCart.objects.create(cart=cart, product=p1, quantity=2)
+        models.ProductInCart.objects.create(cart=other, product=p1, quantity=3)
+        models.ProductInCart.objects.create(cart=other, product=p2)
+
+        cart.merge(other)
+
+        self.assertFalse(models.Cart.objects.filter(pk=other.pk).exists())
+        self.assertEqual(
+            sorted(cart.productincart_set.values_list("product_id", "quantity")),
+            sorted([(p1.id, 5), (p2.id, 1)]),
+        )
+        self.assertEqual((cart.item_count, cart.total), (6, Decimal("54.00")))
+
+    def test_create_order_queries_do_not_grow_with_quantities(self):
+        user1 = UserFactory()
+        address = AddressFactory(user=user1)
+        queries = []
+        for quantity in (1, 50):
+            cart = models.Cart.objects.create(user=user1)
+            models.ProductInCart.objects.create(
+                cart=cart, product=ProductFactory(), quantity=quantity
+            )
+            with CaptureQueriesContext(connection) as context:
+                order = cart.create_order(address, address)
+            queries.append(len(context.captured_queries))
+            self.assertEqual(order.lines.get().quantity, quantity)
+        self.assertEqual(queries[0], queries[1])
+
+
+class TestStock(TestCase):
+    def in_stock_facet(self, product):
+        bitmap = facets.load(models.FacetBitmap.STOCK)[facets.STOCK_VALUE]
+        return bool(bitmap >> product.id & 1)
+
+    def test_checkout_cannot_take_more_than_the_stock(self):
+        user1 = UserFactory()
+        address = AddressFactory(user=user1)
+        plenty = ProductFactory(stock=10)
+        scarce = ProductFactory(stock=2)
+        cart = models.Cart.objects.create(user=user1)
+        models.ProductInCart.objects.create(cart=cart, product=plenty, quantity=3)
+        models.ProductInCart.objects.create(cart=cart, product=scarce, quantity=3)
+
+        with self.assertRaises(stock.OutOfStock):
+            cart.create_order(address, address)
+
+        # nothing was taken, not even from the product that had enough
+        plenty.refresh_from_db()
+        self.assertEqual(plenty.stock, 10)
+        self.assertFalse(models.Order.objects.exists())
+
+        models.ProductInCart.objects.filter(product=scarce).update(quantity=2)
+        order = cart.create_order(address, address)
+        scarce.refresh_from_db()
+        plenty.refresh_from_db()
+        self.assertEqual((scarce.stock, scarce.in_stock), (0, False))
+        self.assertEqual((plenty.stock, plenty.in_stock), (7, True))
+        self.assertFalse(self.in_stock_facet(scarce))
+
+        order.lines.transition(models.OrderLine.CANCELLED)
+        scarce.refresh_from_db()
+        self.assertEqual((scarce.stock, scarce.in_stock), (2, True))
+        self.assertTrue(self.in_stock_facet(scarce))
+
+    def test_stale_save_keeps_the_counted_stock(self):
+        product = ProductFactory(stock=5)
+        stale = models.Product.objects.get(pk=product.pk)
+        stock.reserve({product.id: 5})
+
+        stale.price = Decimal("3.00")
+        stale.save()
+
+        product.refresh_from_db()
+        self.assertEqual((product.stock, product.in_stock), (0, False))
+        self.assertEqual(product.price, Decimal("3.00"))
+        self.assertEqual((stale.stock, stale.in_stock), (0, False))
+        self.assertFalse(self.in_stock_facet(product))
+
+
+class TestOrderDailyRollup(TestCase):
+    def test_rollup_follows_orders_and_matches_a_rebuild(self):
+        def counts():
+            return set(
+                models.OrderDailyRollup.objects.filter(count__gt=0).values_list(
+                    "day", "status", "shipping_country", "count"
+                )
+            )
+
+        user1 = UserFactory()
+        product = ProductFactory()
+        with run_on_commit():
+            orders = OrderFactory.create_batch(3, user=user1, shipping_country="in")
+            OrderFactory(user=user1, shipping_country="uk")
+            lines = [OrderLineFactory(order=order, product=product) for order in orders]
+            orders[0].status = models.Order.PAID
+            orders[0].save()
+            models.OrderLine.objects.filter(pk=lines[1].pk).transition(
+                models.OrderLine.SENT
+            )
+            orders[2].delete()
+            cancelled = OrderLineFactory(order=orders[0], product=product, quantity=3)
+            models.OrderLine.objects.filter(pk=cancelled.pk).transition(
+                models.OrderLine.CANCELLED
+            )
+
+        today = timezone.localdate()
+        expected = {
+            (today, models.Order.NEW, "uk", 1),
+            (today, models.Order.PAID, "in", 1),
+            (today, models.Order.DONE, "in", 1),
+        }
+        self.assertEqual(counts(), expected)
+
+        sales = set(
+            models.ProductDailySales.objects.values_list("day", "product", "quantity")
+        )
+        self.assertEqual(sales, {(today, product.id, 2)})
+
+        models.OrderDailyRollup.objects.all().delete()
+        models.ProductDailySales.objects.all().delete()
+        call_command("rebuild_order_rollups", stdout=StringIO())
+        self.assertEqual(counts(), expected)
+        self.assertEqual(
+            set(
+                models.ProductDailySales.objects.values_list(
+                    "day", "product", "quantity"
+                )
+            ),
+            sales,
+        )
@@ -0,0 +1,65 @@
+from decimal import Decimal
+
+from django.test import TestCase
+from django.urls import reverse
+
+from main import models, search
+
+
+class TestSearch(TestCase):
+    def test_index_follows_product_and_tag_changes(self):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            description="A book about open source",
+            price=Decimal("10.00"),
+        )
+        tag = models.ProductTag.objects.create(name="Essays", slug="essays")
+        cb.tags.add(tag)
+        self.assertEqual(search.search("essay"), [cb])
+
+        tag.name = "Programming"
+        tag.save()
+        self.assertEqual(search.search("essay"), [])
+        self.assertEqual(search.search("progr"), [cb])
+
+        cb.active = False
+        cb.save()
+        self.assertEqual(search.search("cathedral"), [])
+        self.assertFalse(models.SearchTerm.objects.filter(product=cb).exists())
+
+    def test_results_are_ranked_and_match_every_token(self):
+        in_name = models.Product.objects.create(
+            name="Open source guide", slug="open-source-guide", price=Decimal("1.00")
+        )
+        in_description = models.Product.objects.create(
+            name="Cookbook",
+            slug="cookbook",
+            description="Recipes from open kitchens, not source code",
+            price=Decimal("1.00"),
+        )
+        models.Product.objects.create(
+            name="Open season", slug="open-season", price=Decimal("1.00")
+        )
+
+        self.assertEqual(search.search("open sour"), [in_name, in_description])
+        self.assertEqual(search.search("the"), [])
+
+    def test_search_view_and_api(self):
+        product = models.Product.objects.create(
+            name="Backgammon for dummies", slug="backgammon", price=Decimal("13.00")
+        )
+        response = self.client.get(reverse("search"), {"q": "backg"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context["object_list"]), [product])
+
+        response = self.client.get(reverse("api-search"), {"q": "dummies"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"][0]["slug"], "backgammon")
+
+        for limit in ("-1", "0"):
+            response = self.client.get(
+                reverse("api-search"), {"q": "dummies", "limit": limit}
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()["results"]), 1)
@@ -2,7 +2,8 @@ from django.contrib import auth
 from django.test import TestCase
 from django.urls import reverse
 
-from main import models
+from main import jobs, models
+from main.tests import use_temporary_media_root
 from django.core.files.images import ImageFile
 from decimal import Decimal
 
@@ -20,9 +21,48 @@ class TestSignal(TestCase):
                 image.save()
 
         self.assertGreaterEqual(len(cm.output), 1)
+        self.assertTrue(image.is_pending)
+        self.assertFalse(image.thumbnail)
+
+        self.assertEqual(jobs.run_pending(), 1)
+        image.refresh_from_db()
+        self.assertEqual(image.status, models.ProductImage.READY)
+        self.assertTrue(image.thumbnail)
+        for derivative in image.derivatives.all():
+            derivative.file.delete(save=False)
         image.thumbnail.delete(save=False)
         image.image.delete(save=False)
 
+    def test_derivatives_are_generated_on_image_save(self):
+        use_temporary_media_root(self)
+        product = models.Product.objects.create(
+            name="Harry Potter", slug="harry-potter", price=Decimal("10.00")
+        )
+        with open("main/fixtures/sample-images/harry-potter.jpg", "rb") as f:
+            image = models.ProductImage.objects.create(
+                product=product, image=ImageFile(f, name="hp.jpg")
+            )
+        jobs.run_pending()
+
+        derivatives = image.derivatives.all()
+        self.assertEqual(
+            sorted((d.format, d.width, d.height) for d in derivatives),
+            [
+                ("jpeg", 160, 242),
+                ("jpeg", 265, 400),
+                ("webp", 160, 242),
+                ("webp", 265, 400),
+            ],
+        )
+        self.assertIn(" 160w, ", image.webp_srcset)
+        self.assertTrue(image.jpeg_srcset.endswith(" 265w"))
+
+        # saving again without a new image leaves derivatives alone
+        first_ids = sorted(d.id for d in derivatives)
+        image.save()
+        self.assertEqual(jobs.run_pending(), 0)
+        self.assertEqual(sorted(d.id for d in image.derivatives.all()), first_ids)
+
     def test_add_to_basket_login_merge_works(self):
         user1 = models.User.objects.create_user("user1@a.com", "pw432joij")
         cb = models.Product.objects.create(
@@ -1,10 +1,15 @@
+import base64
 from unittest.mock import patch
 from django.contrib import auth
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from decimal import Decimal
 from main import models
 from main import forms
+from main.tests import factories, run_on_commit
 from main.models import User, Cart, ProductInCart, Product
 
 
@@ -72,6 +77,382 @@ class TestProductListView(TestCase):
         )
         self.assertEqual(list(response.context["object_list"]), list(product_list))
 
+    def test_products_page_keyset_pagination(self):
+        for i in range(6):
+            models.Product.objects.create(
+                name="Book %d" % (i % 3), slug="book-%d" % i, price=Decimal("1.00")
+            )
+        product_list = list(models.Product.objects.active().order_by("name", "id"))
+        url = reverse("products-list", kwargs={"tag": "all"})
+
+        response = self.client.get(url)
+        self.assertEqual(list(response.context["object_list"]), product_list[:4])
+        page = response.context["page_obj"]
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+        response = self.client.get(url, {"cursor": page.next_cursor})
+        self.assertEqual(list(response.context["object_list"]), product_list[4:])
+        page = response.context["page_obj"]
+        self.assertTrue(page.has_previous())
+        self.assertFalse(page.has_next())
+
+        response = self.client.get(url, {"cursor": page.previous_cursor})
+        self.assertEqual(list(response.context["object_list"]), product_list[:4])
+        self.assertFalse(response.context["page_obj"].has_previous())
+
+        response = self.client.get(url, {"cursor": "garbage"})
+        self.assertEqual(response.status_code, 404)
+        # well formed, but the key is not a list
+        cursor = base64.urlsafe_b64encode(b'["n",5]').decode()
+        response = self.client.get(url, {"cursor": cursor})
+        self.assertEqual(response.status_code, 404)
+        # a list, but the id is not a number
+        cursor = base64.urlsafe_b64encode(b'["n",["x","abc"]]').decode()
+        response = self.client.get(url, {"cursor": cursor})
+        self.assertEqual(response.status_code, 404)
+
+    def test_products_page_facet_filters(self):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        opensource = cb.tags.create(name="Open source", slug="opensource")
+        essays = cb.tags.create(name="Essays", slug="essays")
+        w = models.Product.objects.create(
+            name="Microsoft Windows guide",
+            slug="microsoft-windows-guide",
+            price=Decimal("120.00"),
+            in_stock=False,
+        )
+        w.tags.add(essays)
+
+        url = reverse("products-list", kwargs={"tag": "essays"})
+        response = self.client.get(url, {"tag": opensource.id})
+        self.assertEqual(list(response.context["object_list"]), [cb])
+        response = self.client.get(url, {"price": "100+"})
+        self.assertEqual(list(response.context["object_list"]), [w])
+        response = self.client.get(url, {"in_stock": "1"})
+        self.assertEqual(list(response.context["object_list"]), [cb])
+
+        prices = {p["key"]: p["count"] for p in response.context["facets"]["prices"]}
+        self.assertEqual(prices["10-25"], 1)
+        self.assertEqual(prices["100+"], 0)
+        self.assertContains(response, "Open source (1)")
+
+
+class TestCatalogCache(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_product_page_is_cached_until_catalog_changes(self):
+        product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        url = reverse("product", args=(product.slug,))
+        response = self.client.get(url)
+        self.assertContains(response, "10.00")
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertContains(response, "10.00")
+
+        product.price = Decimal("12.50")
+        product.save()
+        response = self.client.get(url)
+        self.assertContains(response, "12.50")
+
+    def test_logged_in_product_list_is_not_served_from_page_cache(self):
+        models.Product.objects.create(
+            name="Microsoft Windows guide",
+            slug="microsoft-windows-guide",
+            price=Decimal("12.00"),
+        )
+        url = reverse("products-list", kwargs={"tag": "all"})
+        self.client.get(url)
+        self.client.force_login(models.User.objects.create_user("u@a.com", "pw"))
+        response = self.client.get(url)
+        self.assertIsNotNone(response.context)
+        self.assertContains(response, "Microsoft Windows guide")
+
+
+class TestCartMiddleware(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+
+    def test_cart_is_read_from_cache(self):
+        self.client.get(reverse("add_to_cart"), {"product_id": self.product.id})
+        cache.clear()
+
+        # the session, then the cart for the basket badge
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("about_us"))
+        self.assertContains(response, "1\n        items in basket")
+        with self.assertNumQueries(1):
+            self.client.get(reverse("about_us"))
+
+    def test_cart_is_only_loaded_when_used(self):
+        self.client.get(reverse("add_to_cart"), {"product_id": self.product.id})
+        self.assertIn("cart_id", self.client.session)
+        cache.clear()
+
+        # no basket badge on the API, no cart
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("api-search"), {"q": "cathedral"})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(
+            [q for q in context.captured_queries if '"main_cart"' in q["sql"]]
+        )
+
+    def test_stale_cart_id_is_dropped_from_session(self):
+        self.client.get(reverse("add_to_cart"), {"product_id": self.product.id})
+        Cart.objects.all().delete()
+
+        response = self.client.get(reverse("cart"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context["formset"])
+        self.assertNotIn("cart_id", self.client.session)
+
+
+class TestAddToCart(TestCase):
+    def test_add_to_cart_increments_a_single_line(self):
+        product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        response = self.client.get(reverse("add_to_cart"), {"product_id": product.id})
+        self.assertRedirects(response, reverse("product", args=(product.slug,)))
+
+        response = self.client.get(
+            reverse("add_to_cart"),
+            {"product_id": product.id},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        cart = Cart.objects.get()
+        self.assertEqual(
+            response.json(),
+            {
+                "cart_id": cart.id,
+                "product_id": product.id,
+                "item_count": 2,
+                "total": "20.00",
+            },
+        )
+        line = ProductInCart.objects.get()
+        self.assertEqual(line.quantity, 2)
+
+
+class TestCheckout(TestCase):
+    def test_checkout_retries_do_not_create_duplicate_orders(self):
+        user = factories.UserFactory()
+        address = factories.AddressFactory(user=user)
+        product = factories.ProductFactory(slug="atlas")
+        self.client.force_login(user)
+        self.client.get(reverse("add_to_cart"), {"product_id": product.id})
+        response = self.client.get(reverse("address_select"))
+        key = response.context["form"]["idempotency_key"].value()
+        data = {
+            "billing_address": address.id,
+            "shipping_address": address.id,
+            "idempotency_key": key,
+        }
+
+        for _ in range(2):
+            response = self.client.post(reverse("address_select"), data)
+            self.assertRedirects(response, reverse("checkout_done"))
+        order = models.Order.objects.get()
+        self.assertEqual(order.idempotency_key, key)
+        self.assertEqual(order.cart.status, Cart.SUBMITTED)
+
+        # the same cart cannot be ordered twice either
+        with self.assertLogs("main.models", level="INFO"):
+            self.assertEqual(order.cart.create_order(address, address), order)
+        self.assertEqual(models.Order.objects.count(), 1)
+
+
+@override_settings(CART_STORAGE="session")
+class TestSessionCart(TestCase):
+    def setUp(self):
+        self.product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+
+    def test_anonymous_cart_is_saved_at_login(self):
+        user = models.User.objects.create_user("user1@a.com", "pw432joij")
+        for _ in range(3):
+            self.client.get(reverse("add_to_cart"), {"product_id": self.product.id})
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(ProductInCart.objects.exists())
+
+        response = self.client.get(reverse("cart"))
+        formset = response.context["formset"]
+        self.assertEqual(formset.forms[0].product, self.product)
+        self.assertContains(response, "3\n        items in basket")
+        self.client.post(
+            reverse("cart"),
+            {
+                "form-TOTAL_FORMS": "1",
+                "form-INITIAL_FORMS": "1",
+                "form-0-product_id": str(self.product.id),
+                "form-0-quantity": "2",
+            },
+        )
+
+        self.client.post(
+            reverse("login"), {"email": "user1@a.com", "password": "pw432joij"}
+        )
+        cart = Cart.objects.get(user=user)
+        self.assertEqual((cart.item_count, cart.total), (2, Decimal("20.00")))
+        self.assertEqual(ProductInCart.objects.get(cart=cart).quantity, 2)
+        self.assertEqual(self.client.session["cart_id"], cart.id)
+        self.assertNotIn("cart", self.client.session)
+
+
+class TestConditionalGet(TestCase):
+    def test_product_page_answers_304_until_it_changes(self):
+        product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        url = reverse("product", args=(product.slug,))
+        response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertTrue(response.has_header("Last-Modified"))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        product.tags.create(name="Open source", slug="opensource")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_product_page_is_not_conditional_for_personal_pages(self):
+        product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        url = reverse("product", args=(product.slug,))
+        etag = self.client.get(url)["ETag"]
+
+        user = models.User.objects.create_user("user1@a.com", "pw432joij")
+        self.client.force_login(user)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("ETag"))
+        self.assertIn("private", response["Cache-Control"])
+        self.assertIn("Cookie", response["Vary"])
+
+    def test_paid_orders_api_answers_304(self):
+        user = models.User.objects.create_superuser("admin@a.com", "pw432joij")
+        order = factories.OrderFactory(user=user, status=models.Order.PAID)
+        self.client.force_login(user)
+        url = reverse("order-list")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        order.shipping_city = "Pune"
+        order.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class TestOrderLineTransition(TestCase):
+    def test_bulk_transition_completes_orders_like_line_saves(self):
+        user = models.User.objects.create_superuser("admin@a.com", "pw432joij")
+        product = factories.ProductFactory()
+        done, partial = factories.OrderFactory.create_batch(
+            2, user=user, status=models.Order.PAID
+        )
+        lines = factories.OrderLineFactory.create_batch(
+            3, order=done, product=product, quantity=2
+        )
+        lines += factories.OrderLineFactory.create_batch(
+            2, order=partial, product=product
+        )
+        self.client.force_login(user)
+
+        # a fixed count however many lines, the daily rollup and sales
+        # are moved after the commit
+        with self.assertNumQueries(10):
+            response = self.client.post(
+                reverse("orderline-transition"),
+                {
+                    "ids": [line.id for line in lines[:4]],
+                    "status": models.OrderLine.SENT,
+                },
+                content_type="application/json",
+            )
+        self.assertEqual(response.json(), {"updated": 4})
+        done.refresh_from_db()
+        partial.refresh_from_db()
+        self.assertEqual(done.status, models.Order.DONE)
+        self.assertEqual(partial.status, models.Order.PAID)
+        self.assertEqual(sum(done.lines.values_list("quantity_sent", flat=True)), 6)
+
+        # the per-line signal agrees once the last line is sent
+        lines[4].refresh_from_db()
+        lines[4].send()
+        partial.refresh_from_db()
+        self.assertEqual(partial.status, models.Order.DONE)
+
+
+class TestBestsellersView(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bestsellers_ranks_products_not_names(self):
+        first = factories.ProductFactory(name="Atlas", slug="atlas")
+        second = factories.ProductFactory(name="Atlas", slug="atlas-2")
+        hidden = factories.ProductFactory(name="Gone", slug="gone", active=False)
+        with run_on_commit():
+            order = factories.OrderFactory()
+            factories.OrderLineFactory(order=order, product=first, quantity=2)
+            factories.OrderLineFactory(order=order, product=second, quantity=5)
+            factories.OrderLineFactory(order=order, product=hidden, quantity=9)
+            line = factories.OrderLineFactory(order=order, product=first, quantity=1)
+            line.quantity = 4
+            line.save()
+            # cancelled units are not sales, whichever way they are cancelled
+            cancelled = factories.OrderLineFactory(
+                order=order, product=second, quantity=7
+            )
+            cancelled.status = models.OrderLine.CANCELLED
+            cancelled.save()
+            bulk = factories.OrderLineFactory(order=order, product=second, quantity=8)
+            models.OrderLine.objects.filter(pk=bulk.pk).transition(
+                models.OrderLine.CANCELLED
+            )
+
+        response = self.client.get(reverse("bestsellers"), {"days": "60"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["days"], 60)
+        self.assertEqual(
+            [(p.id, p.units) for p in response.context["object_list"]],
+            [(first.id, 6), (second.id, 5)],
+        )
+        with self.assertNumQueries(1):
+            self.client.get(reverse("bestsellers"), {"days": "60"})
+
 
 class TestSignUpView(TestCase):
     def test_user_signup_pages_loads_correctly(self):
@@ -18,6 +18,11 @@ urlpatterns = [
     ),
     path("", TemplateView.as_view(template_name="home.html"), name="home"),
     path("contact-us/", views.ContactUsView.as_view(), name="contact_us"),
+    path(
+        "products/bestsellers/",
+        views.BestsellersView.as_view(),
+        name="bestsellers",
+    ),
     path("products/<slug:tag>/", views.ProductListView.as_view(), name="products-list"),
     path(
         "product/<slug:slug>/",
@@ -25,6 +30,7 @@ urlpatterns = [
         views.ProductDetailView.as_view(),
         name="product",
     ),
+    path("search/", views.SearchView.as_view(), name="search"),
     path("signup/", views.SignUpView.as_view(), name="signup"),
     path(
         "login/",
@@ -53,6 +59,7 @@ urlpatterns = [
         views.AddressSelectionView.as_view(),
         name="address_select",
     ),
+    path("api/search/", api.ProductSearchView.as_view(), name="api-search"),
     path("api/", include(router.urls)),
     path("customer-service/<int:order_id>/", views.room, name="cs_chat"),
 ]
@@ -1,14 +1,24 @@
+import hashlib
 import logging
+import uuid
 
 import django_filters
 from django import forms as django_forms
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
 from django.db import models as django_models
-from django.http import HttpResponseRedirect
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse_lazy, reverse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.views.generic import (
     FormView,
     ListView,
@@ -19,8 +29,24 @@ from django.views.generic import (
 )
 from django_filters.views import FilterView
 
-from .forms import UserCreationForm, CartLineFormSet, ContactForm, AddressSelectionForm
-from .models import Product, ProductTag, Address, Cart, ProductInCart, Order
+from . import caching, carts, facets, search
+from .forms import (
+    UserCreationForm,
+    CartLineFormSet,
+    ContactForm,
+    AddressSelectionForm,
+    SessionCartLineFormSet,
+)
+from .models import (
+    Product,
+    ProductTag,
+    Address,
+    Cart,
+    ProductInCart,
+    Order,
+    ProductDailySales,
+)
+from .paginators import KeysetPage, KeysetPaginator
 
 logger = logging.getLogger(__name__)
 
@@ -56,33 +82,264 @@ class ContactUsView(FormView):
         return super(ContactUsView, self).form_valid(form)
 
 
-class ProductListView(ListView):
+def is_public_request(request):
+    """True when the page looks the same for everybody: an anonymous
+    visitor with no cart and no pending messages"""
+    return (
+        not request.user.is_authenticated
+        and not request.cart
+        and not len(messages.get_messages(request))
+    )
+
+
+class CatalogCacheMixin:
+    """Catalog Cache Mixin
+
+    Notes
+    -----
+    Serves the rendered page from the cache to anonymous visitors with
+    no cart and no pending messages, i.e. when the page looks the same
+    for everybody. Keys carry the catalog version, see ``main.caching``.
+    """
+
+    def can_cache_page(self, request):
+        return request.method in ("GET", "HEAD") and is_public_request(request)
+
+    def get(self, request, *args, **kwargs):
+        if not self.can_cache_page(request):
+            return super().get(request, *args, **kwargs)
+
+        key = caching.catalog_key("page", request.get_full_path())
+        content = cache.get(key)
+        if content is not None:
+            return HttpResponse(content)
+
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == 200:
+            response.add_post_render_callback(
+                lambda r: cache.set(key, r.content, settings.CATALOG_CACHE_TIMEOUT)
+            )
+        return response
+
+
+class ProductListView(CatalogCacheMixin, ListView):
     """Product List View
 
     Notes
     -----
-    Lists products
+    Lists products. Pages are keyset based on ``(name, id)`` and are
+    selected with an opaque ``?cursor=`` token instead of a page number.
+
+    The listing can be narrowed with ``?tag=<id>`` (repeatable, products
+    must carry every tag), ``?price=<bucket>`` and ``?in_stock=1``; the
+    counts shown next to each option come from ``main.facets``.
     """
 
     template_name = "product_list.html"
     paginate_by = 4
+    paginator_class = KeysetPaginator
+    ordering = ("name", "id")
+
+    def get_filters(self):
+        tag_ids = []
+        for tag_id in self.request.GET.getlist("tag"):
+            if tag_id.isdigit() and int(tag_id) not in tag_ids:
+                tag_ids.append(int(tag_id))
+        price = self.request.GET.get("price")
+        if price not in facets.PRICE_BUCKET_KEYS:
+            price = None
+        return {
+            "tag_ids": tag_ids,
+            "price": price,
+            "in_stock": self.request.GET.get("in_stock") == "1",
+        }
 
     def get_queryset(self):
         tag = self.kwargs["tag"]
         self.tag = None
         if tag != "all":
             self.tag = get_object_or_404(ProductTag, slug=tag)
+        self.filters = self.get_filters()
         if self.tag:
             products = Product.objects.active().filter(tags=self.tag)
         else:
             products = Product.objects.active()
-        return products.order_by("name")
+        for tag_id in self.filters["tag_ids"]:
+            products = products.filter(tags__id=tag_id)
+        if self.filters["price"]:
+            low, high = facets.price_range(self.filters["price"])
+            products = products.filter(price__gte=low)
+            if high is not None:
+                products = products.filter(price__lt=high)
+        if self.filters["in_stock"]:
+            products = products.filter(in_stock=True)
+        return products.order_by(*self.ordering)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        tag_ids = list(self.filters["tag_ids"])
+        if self.tag:
+            tag_ids.append(self.tag.id)
+        counts = caching.get_or_set(
+            caching.catalog_key("facets", tag_ids, sorted(self.filters.items())),
+            lambda: facets.facet_counts(
+                tag_ids, self.filters["price"], self.filters["in_stock"]
+            ),
+        )
+        if self.tag:
+            counts["tags"] = [t for t in counts["tags"] if t["tag"] != self.tag]
+        context["tag"] = self.tag
+        context["filters"] = self.filters
+        context["facets"] = counts
+        querystring = self.request.GET.copy()
+        querystring.pop("cursor", None)
+        context["querystring"] = querystring.urlencode()
+        return context
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return self.paginator_class(queryset, per_page, ordering=self.ordering)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = self.get_paginator(queryset, page_size)
+        cursor = self.request.GET.get("cursor")
+        key = caching.catalog_key(
+            "products", self.kwargs["tag"], sorted(self.filters.items()), cursor
+        )
+        cached = cache.get(key)
+        if cached is None:
+            try:
+                page = paginator.page(cursor)
+            except InvalidPage as e:
+                raise Http404(str(e))
+            cached = (page.object_list, page.has_next(), page.has_previous())
+            cache.set(key, cached, settings.CATALOG_CACHE_TIMEOUT)
+        page = KeysetPage(cached[0], paginator, cached[1], cached[2])
+        return paginator, page, page.object_list, page.has_other_pages()
+
+
+class SearchView(ListView):
+    """Search View
+
+    Notes
+    -----
+    Ranked product search over the local inverted index, see
+    ``main.search``.
+    """
 
+    template_name = "search_results.html"
+    limit = 20
+
+    def get_queryset(self):
+        self.query = self.request.GET.get("q", "").strip()
+        return search.search(self.query, limit=self.limit)
 
-class ProductDetailView(DetailView):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.query
+        return context
+
+
+class BestsellersView(ListView):
+    """Bestsellers View
+
+    Notes
+    -----
+    The best selling products of the last ``?days=`` (30, 60 or 90)
+    days, ranked from the daily sales counts with their units sold.
+    """
+
+    template_name = "bestsellers.html"
+    periods = (30, 60, 90)
+    limit = 10
+
+    def get_queryset(self):
+        days = self.request.GET.get("days", "")
+        self.days = int(days) if days.isdigit() else self.periods[0]
+        if self.days not in self.periods:
+            self.days = self.periods[0]
+        ranking = ProductDailySales.objects.top(
+            self.days, limit=self.limit, active_only=True
+        )
+        products = Product.objects.in_bulk([product_id for product_id, _ in ranking])
+        bestsellers = []
+        for product_id, units in ranking:
+            if product_id in products:
+                products[product_id].units = units
+                bestsellers.append(products[product_id])
+        return bestsellers
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["days"] = self.days
+        context["periods"] = self.periods
+        return context
+
+
+def product_validators(request, slug):
+    """Return the values a product page depends on, for conditional GET.
+
+    Looked up once per request and cached under the catalog version, so
+    a 304 costs no query at all.
+    """
+    if not hasattr(request, "_product_validators"):
+        request._product_validators = caching.get_or_set(
+            caching.catalog_key("product-validators", slug),
+            lambda: Product.objects.filter(slug=slug)
+            .annotate(
+                images_updated=Max("productimage__date_updated"),
+                images=Count("productimage"),
+            )
+            .values_list("id", "date_updated", "images_updated", "images")
+            .first(),
+        )
+    return request._product_validators
+
+
+# Only public pages are answered conditionally: the basket badge, flash
+# messages and the logged-in menu are not covered by the validators
+def product_etag(request, slug):
+    if not is_public_request(request):
+        return None
+    validators = product_validators(request, slug)
+    if validators is None:
+        return None
+    return hashlib.md5(repr(validators).encode()).hexdigest()
+
+
+def product_last_modified(request, slug):
+    if not is_public_request(request):
+        return None
+    validators = product_validators(request, slug)
+    if validators is None:
+        return None
+    _, date_updated, images_updated, _ = validators
+    return max(date_updated, images_updated or date_updated)
+
+
+@method_decorator(
+    condition(etag_func=product_etag, last_modified_func=product_last_modified),
+    name="dispatch",
+)
+class ProductDetailView(CatalogCacheMixin, DetailView):
     template_name = "product_detail.html"
     model = Product
 
+    def get_queryset(self):
+        return Product.objects.prefetch_related("productimage_set__derivatives", "tags")
+
+    def get_object(self, queryset=None):
+        return caching.get_or_set(
+            caching.catalog_key("product", self.kwargs[self.slug_url_kwarg]),
+            lambda: super(ProductDetailView, self).get_object(queryset),
+        )
+
+    def get(self, request, *args, **kwargs):
+        response = super().get(request, *args, **kwargs)
+        if not is_public_request(request):
+            patch_cache_control(response, private=True)
+        patch_vary_headers(response, ("Cookie",))
+        return response
+
 
 class AddressListView(LoginRequiredMixin, ListView):
     model = Address
@@ -134,12 +391,38 @@ class AddressSelectionView(LoginRequiredMixin, FormView):
         kwargs["user"] = self.request.user
         return kwargs
 
+    def get_initial(self):
+        # one key per rendered form: resubmitting it can only ever
+        # give back the same order
+        return {"idempotency_key": uuid.uuid4().hex}
+
     def form_valid(self, form):
-        del self.request.session["cart_id"]
+        key = form.cleaned_data["idempotency_key"]
+        if (
+            key
+            and Order.objects.filter(
+                user=self.request.user, idempotency_key=key
+            ).exists()
+        ):
+            logger.info("Checkout retried with key %s", key)
+            return super().form_valid(form)
+
         cart = self.request.cart
-        cart.create_order(
-            form.cleaned_data["billing_address"], form.cleaned_data["shipping_address"]
-        )
+        if not cart:
+            messages.error(self.request, "Your cart is empty.")
+            return HttpResponseRedirect(reverse("cart"))
+        if isinstance(cart, carts.SessionCart):
+            cart = cart.materialize(self.request.user)
+        try:
+            cart.create_order(
+                form.cleaned_data["billing_address"],
+                form.cleaned_data["shipping_address"],
+                idempotency_key=key,
+            )
+        except ValidationError as e:
+            form.add_error(None, e)
+            return self.form_invalid(form)
+        self.request.session.pop("cart_id", None)
         return super().form_valid(form)
 
 
@@ -173,10 +456,21 @@ class OrderView(UserPassesTestMixin, FilterView):
         return self.request.user.is_staff is True
 
 
+def wants_json(request):
+    return request.is_ajax() or "application/json" in request.META.get(
+        "HTTP_ACCEPT", ""
+    )
+
+
 def add_to_cart(request):
     """
     Method to add products to the cart
 
+    Notes
+    -----
+    XHR requests, or requests accepting JSON, get the new cart summary
+    back instead of a redirect to the product page.
+
     Parameters
     ----------
     request
@@ -188,18 +482,25 @@ def add_to_cart(request):
     product = get_object_or_404(Product, pk=request.GET.get("product_id"))
     cart = request.cart
     if not request.cart:
-        if request.user.is_authenticated:
-            user = request.user
+        if carts.uses_session(request.user):
+            cart = carts.SessionCart(request.session)
         else:
-            user = None
-        cart = Cart.objects.create(user=user)
-        request.session["cart_id"] = cart.id
-    cart_in_product, created = ProductInCart.objects.get_or_create(
-        cart=cart, product=product
-    )
-    if not created:
-        cart_in_product.quantity += 1
-        cart_in_product.save()
+            if request.user.is_authenticated:
+                user = request.user
+            else:
+                user = None
+            cart = Cart.objects.create(user=user)
+            request.session["cart_id"] = cart.id
+    cart.add_product(product)
+    if wants_json(request):
+        return JsonResponse(
+            {
+                "cart_id": cart.id,
+                "product_id": product.id,
+                "item_count": cart.item_count,
+                "total": str(cart.total),
+            }
+        )
     return HttpResponseRedirect(reverse("product", args=(product.slug,)))
 
 
@@ -210,10 +511,14 @@ def manage_cart(request):
     if not request.cart:
         return render(request, "cart.html", {"formset": None})
 
+    if isinstance(request.cart, carts.SessionCart):
+        return manage_session_cart(request)
+
     if request.method == "POST":
         formset = CartLineFormSet(request.POST, instance=request.cart)
         if formset.is_valid():
             formset.save()
+            request.cart.refresh_summary()
     else:
         formset = CartLineFormSet(instance=request.cart)
     if request.cart.is_empty():
@@ -222,5 +527,20 @@ def manage_cart(request):
     return render(request, "cart.html", {"formset": formset})
 
 
+def manage_session_cart(request):
+    cart = request.cart
+    if request.method == "POST":
+        formset = SessionCartLineFormSet(request.POST, lines=cart.lines())
+        if formset.is_valid():
+            cart.update_quantities(formset.quantities())
+            formset = SessionCartLineFormSet(lines=cart.lines())
+    else:
+        formset = SessionCartLineFormSet(lines=cart.lines())
+    if cart.is_empty():
+        return render(request, "cart.html", {"formset": None})
+
+    return render(request, "cart.html", {"formset": formset})
+
+
 def room(request, order_id):
     return render(request, "chat_room.html", {"room_name_json": str(order_id)})